@@ -1,24 +1,46 @@
+from __future__ import annotations
+
 import logging
 import os
-from functools import lru_cache
-from urllib.parse import urlparse
-
-from sqlalchemy import create_engine, text
-from sqlalchemy.engine import Engine
-from sqlalchemy.exc import SQLAlchemyError
-from sqlalchemy.orm import sessionmaker
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from enum import IntEnum
+from functools import cache
+from threading import Lock
+from typing import TYPE_CHECKING, NewType
+
+# SQLAlchemy is imported lazily so config validation stays cheap to import.
+if TYPE_CHECKING:
+    from sqlalchemy.engine import Connection, Engine
+    from sqlalchemy.orm import sessionmaker
 
 LOGGER = logging.getLogger(__name__)
 
 _RAILWAY_MARKER_ENV_KEYS = ("RAILWAY_ENVIRONMENT", "RAILWAY_PROJECT_ID")
-_POSTGRES_SCHEMES = {"postgresql", "postgres", "postgresql+psycopg2"}
+_POSTGRES_SCHEMES = frozenset({"postgresql", "postgres", "postgresql+psycopg2"})
 _PUBLIC_DB_ENV_KEYS = ("DATABASE_PUBLIC_URL", "DATABASE_URL_PUBLIC")
+_TRUTHY_VALUES = frozenset({"1", "true", "yes", "on", "require"})
+_SSL_SETTINGS = {
+    **dict.fromkeys(_TRUTHY_VALUES, True),
+    **dict.fromkeys(("0", "false", "no", "off", "disable"), False),
+}
+
+# Hosts produced by _split_db_url are already stripped and lowercased.
+Hostname = NewType("Hostname", str)
+
+_ENGINE: Engine | None = None
+_ENGINE_LOCK = Lock()
+_SESSION_FACTORY: sessionmaker | None = None
 
 
+@cache
 def _read_env(name: str) -> str:
-    return (os.getenv(name) or "").strip()
+    # Env vars are fixed for the process lifetime; tests call clearEnvCache().
+    value = os.environ.get(name)
+    return value.strip() if value else ""
 
 
+@cache
 def _first_set_env(*names: str) -> tuple[str | None, str]:
     for name in names:
         value = _read_env(name)
@@ -27,8 +49,30 @@ def _first_set_env(*names: str) -> tuple[str | None, str]:
     return None, ""
 
 
+def _read_int_env(name: str, default: int) -> int:
+    raw = _read_env(name)
+    if not raw:
+        return default
+    try:
+        return int(raw)
+    except ValueError:
+        return default
+
+
+def clearEnvCache() -> None:
+    # Same name as the gtfs_agent/schema_synthesis hooks; gtfs_agent's also calls this one.
+    _read_env.cache_clear()
+    _first_set_env.cache_clear()
+    _validate_database_url.cache_clear()
+    _select_database_url.cache_clear()
+    _resolve_database_target.cache_clear()
+    _resolve_connect_args.cache_clear()
+
+
 def _is_truthy(value: str) -> bool:
-    return value.strip().lower() in {"1", "true", "yes", "on", "require"}
+    normalized = value.strip().lower()
+    # "1" and "true" are by far the common spellings; check them first.
+    return normalized == "1" or normalized == "true" or normalized in _TRUTHY_VALUES
 
 
 def _runtime_name() -> str:
@@ -44,28 +88,50 @@ def _is_running_on_railway() -> bool:
     return _runtime_name() == "railway"
 
 
-def _extract_db_host(database_url: str) -> str:
-    parsed = urlparse(database_url)
-    return (parsed.hostname or "").strip().lower()
+def _split_db_url(database_url: str) -> tuple[str, Hostname, int | None]:
+    # DB URLs only need scheme/host/port, so skip urlparse's full URI grammar.
+    scheme, separator, rest = database_url.partition("://")
+    if not separator:
+        return "", Hostname(""), None
+    authority = rest
+    for delimiter in "/?#":
+        authority = authority.partition(delimiter)[0]
+    hostport = authority.rpartition("@")[2]
+    if hostport.startswith("["):
+        host, _, tail = hostport[1:].partition("]")
+        port_text = tail[1:] if tail.startswith(":") else ""
+    else:
+        host, _, port_text = hostport.partition(":")
+    port = int(port_text) if port_text.isascii() and port_text.isdigit() else None
+    return scheme.strip().lower(), Hostname(host.strip().lower()), port
 
 
-def _extract_db_port(database_url: str) -> int | None:
-    parsed = urlparse(database_url)
-    return parsed.port
+def _extract_db_host_port(database_url: str) -> tuple[Hostname, int | None]:
+    _, host, port = _split_db_url(database_url)
+    return host, port
 
 
-def _is_railway_internal_host(hostname: str) -> bool:
-    host = (hostname or "").strip().lower()
-    return host == "postgres.railway.internal" or host.endswith(".railway.internal")
+class HostClass(IntEnum):
+    OTHER = 0
+    INTERNAL = 1
+    PUBLIC = 2
 
 
-def _is_railway_public_host(hostname: str) -> bool:
-    host = (hostname or "").strip().lower()
-    return host.endswith(".proxy.rlwy.net") or host.endswith(".rlwy.net")
+@cache
+def _classify_host(host: Hostname) -> HostClass:
+    labels = host.rsplit(".", 2)
+    # Require a subdomain so bare "rlwy.net" / "railway.internal" stay OTHER.
+    if len(labels) < 3:
+        return HostClass.OTHER
+    tail = labels[1] + "." + labels[2]
+    if tail == "railway.internal":
+        return HostClass.INTERNAL
+    if tail == "rlwy.net":
+        return HostClass.PUBLIC
+    return HostClass.OTHER
 
 
-def _redact_host(hostname: str) -> str:
-    host = (hostname or "").strip().lower()
+def _redact_host(host: Hostname) -> str:
     if not host:
         return "<missing>"
     labels = host.split(".")
@@ -74,24 +140,24 @@ def _redact_host(hostname: str) -> str:
     return host[:1] + "***"
 
 
-def _validate_database_url(selected_key: str, selected_url: str) -> tuple[str, int | None]:
-    parsed = urlparse(selected_url)
-    scheme = (parsed.scheme or "").strip().lower()
+@cache
+def _validate_database_url(selected_key: str, selected_url: str) -> tuple[Hostname, int | None]:
+    scheme, host, port = _split_db_url(selected_url)
     if scheme not in _POSTGRES_SCHEMES:
         raise RuntimeError(
             f"{selected_key} is not a valid Postgres URL. "
             "Set a full postgresql:// URL."
         )
 
-    host = (parsed.hostname or "").strip().lower()
     if not host:
         raise RuntimeError(
             f"{selected_key} is missing a hostname. "
             "Set DATABASE_PUBLIC_URL to Railway's Public connection URL."
         )
-    return host, parsed.port
+    return host, port
 
 
+@cache
 def _select_database_url() -> tuple[str, str]:
     database_url = _read_env("DATABASE_URL")
     public_key, public_url = _first_set_env(*_PUBLIC_DB_ENV_KEYS)
@@ -116,7 +182,7 @@ def _select_database_url() -> tuple[str, str]:
             )
 
     selected_host, _ = _validate_database_url(selected_key, selected_url)
-    if not on_railway and _is_railway_internal_host(selected_host):
+    if not on_railway and _classify_host(selected_host) is HostClass.INTERNAL:
         raise RuntimeError(
             "Detected Railway internal DB host outside Railway runtime. "
             "Set DATABASE_PUBLIC_URL (or DATABASE_URL_PUBLIC) to Railway's Public connection URL."
@@ -124,44 +190,88 @@ def _select_database_url() -> tuple[str, str]:
     return selected_key, selected_url
 
 
+@cache
+def _resolve_database_target() -> tuple[str, str, Hostname, int | None]:
+    selected_key, selected_url = _select_database_url()
+    host, port = _validate_database_url(selected_key, selected_url)
+    return selected_key, selected_url, host, port
+
+
 def _build_connect_args(database_url: str) -> dict[str, str]:
-    # Preserve explicit URL-level sslmode.
-    if "sslmode=" in database_url.lower():
-        return {}
+    # The cached settings are shared; every caller gets its own mutable dict.
+    return dict(_resolve_connect_args(database_url))
+
+
+@cache
+def _resolve_connect_args(database_url: str) -> tuple[tuple[str, str], ...]:
+    # Preserve explicit URL-level sslmode; it can only live in the query string.
+    _, has_query, query = database_url.rpartition("?")
+    if has_query and "sslmode=" in query.lower():
+        return ()
 
-    host = _extract_db_host(database_url)
-    if _is_railway_public_host(host):
-        return {"sslmode": "require"}
+    host, _ = _extract_db_host_port(database_url)
+    if _classify_host(host) is HostClass.PUBLIC:
+        return (("sslmode", "require"),)
 
-    ssl_value = _read_env("DATABASE_SSL")
-    if _is_truthy(ssl_value):
-        return {"sslmode": "require"}
-    return {}
+    if _SSL_SETTINGS.get(_read_env("DATABASE_SSL").lower()) is True:
+        return (("sslmode", "require"),)
+    return ()
 
 
 def validate_database_config() -> None:
-    selected_key, selected_url = _select_database_url()
-    host, port = _validate_database_url(selected_key, selected_url)
-    port_label = str(port) if port is not None else "unknown"
+    selected_key, _, host, port = _resolve_database_target()
+    if not LOGGER.isEnabledFor(logging.INFO):
+        return
     LOGGER.info(
         "DB config selected source=%s runtime=%s host=%s port=%s",
         selected_key,
         _runtime_name(),
         _redact_host(host),
-        port_label,
+        port if port is not None else "unknown",
     )
 
 
+def _open_pinged_connection(engine: Engine) -> Connection:
+    from sqlalchemy import text
+
+    connection = engine.connect()
+    try:
+        connection.execute(text("SELECT 1"))
+    except BaseException:
+        connection.close()
+        raise
+    return connection
+
+
+def _warm_connection_count(engine: Engine) -> int:
+    pool_size = max(1, engine.pool.size())
+    # Serverless instances are short-lived and many; one ping per cold start is enough.
+    default = 1 if _runtime_name() == "vercel" else pool_size
+    return min(pool_size, max(1, _read_int_env("DB_WARM_CONNECTIONS", default)))
+
+
 def verify_database_connection() -> None:
-    selected_key, selected_url = _select_database_url()
-    host, port = _validate_database_url(selected_key, selected_url)
+    from sqlalchemy.exc import SQLAlchemyError
+
+    selected_key, _, host, port = _resolve_database_target()
     redacted_host = _redact_host(host)
     port_label = str(port) if port is not None else "unknown"
 
     try:
         engine = get_engine()
-        with engine.connect() as connection:
-            connection.execute(text("SELECT 1"))
+        # Open the pool up front so first requests reuse warm connections.
+        # Checkouts are held until all are open, so each one is a distinct connection.
+        warm_count = _warm_connection_count(engine)
+        with ExitStack() as stack:
+            with ThreadPoolExecutor(max_workers=warm_count) as executor:
+                futures = [
+                    executor.submit(_open_pinged_connection, engine) for _ in range(warm_count)
+                ]
+            for future in futures:
+                if future.exception() is None:
+                    stack.callback(future.result().close)
+            for future in futures:
+                future.result()
     except SQLAlchemyError as exc:
         raise RuntimeError(
             "Database connectivity check failed for "
@@ -170,16 +280,48 @@ def verify_database_connection() -> None:
         ) from exc
 
 
-@lru_cache(maxsize=1)
 def get_engine() -> Engine:
+    global _ENGINE
+    engine = _ENGINE
+    if engine is not None:
+        return engine
+    with _ENGINE_LOCK:
+        engine = _ENGINE
+        if engine is None:
+            engine = _ENGINE = _create_engine()
+    return engine
+
+
+def _create_engine() -> Engine:
+    from sqlalchemy import create_engine
+
     _, database_url = _select_database_url()
     return create_engine(
         database_url,
         pool_pre_ping=True,
+        # LIFO keeps reusing the warmest connection so idle overflow can age out.
+        pool_use_lifo=True,
+        pool_recycle=1800,
+        pool_size=max(1, _read_int_env("DB_POOL_SIZE", 10)),
+        max_overflow=max(0, _read_int_env("DB_MAX_OVERFLOW", 10)),
+        pool_timeout=30,
         future=True,
         connect_args=_build_connect_args(database_url),
     )
 
 
 def get_session_factory() -> sessionmaker:
-    return sessionmaker(bind=get_engine(), autoflush=False, autocommit=False, future=True)
+    global _SESSION_FACTORY
+    factory = _SESSION_FACTORY
+    if factory is not None:
+        return factory
+    from sqlalchemy.orm import sessionmaker
+
+    engine = get_engine()
+    with _ENGINE_LOCK:
+        factory = _SESSION_FACTORY
+        if factory is None:
+            factory = _SESSION_FACTORY = sessionmaker(
+                bind=engine, autoflush=False, autocommit=False, future=True
+            )
+    return factory
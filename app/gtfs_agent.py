@@ -1,16 +1,26 @@
 import copy
 import json
 import os
+import random
 import re
+import ssl
 import time
-from threading import Lock
-from typing import Any
+from concurrent.futures import Future
+from dataclasses import dataclass
+from functools import lru_cache
+from itertools import islice
+from operator import itemgetter
+from threading import Lock, RLock
+from types import MappingProxyType
+from typing import Any, Callable, Mapping
 from urllib import error as urlerror
 from urllib import request as urlrequest
 
 from sqlalchemy import text
+from sqlalchemy.sql.elements import TextClause
 from sqlalchemy.exc import SQLAlchemyError
 
+from app.db import clearEnvCache as _clear_db_env_cache
 from app.db import get_engine
 
 DEFAULT_GEMINI_MODEL = "gemini-2.0-flash"
@@ -112,86 +122,102 @@ SOURCE_OF_TRUTH_SCHEMA: dict[str, Any] = {
     ],
 }
 
-_REQUIRED_TEMPLATE_KEYS = {
-    "list_routes",
-    "route_details",
-    "list_stops",
-    "stop_details",
-    "stops_on_route",
-    "routes_serving_stop",
-    "arrivals_for_stop",
-    "busiest_stops",
-    "busiest_routes",
-    "accessible_stops",
-    "accessible_trips",
+# SOURCE_OF_TRUTH_SCHEMA is static, so its prompt serializations are built once.
+_SOURCE_TRUTH_JSON = json.dumps(SOURCE_OF_TRUTH_SCHEMA, ensure_ascii=True)
+_QUERY_PLAN_TRUTH_JSON = json.dumps(
+    {
+        "dialect": SOURCE_OF_TRUTH_SCHEMA.get("dialect"),
+        "tables": SOURCE_OF_TRUTH_SCHEMA.get("tables"),
+        "joins": SOURCE_OF_TRUTH_SCHEMA.get("joins"),
+    },
+    ensure_ascii=True,
+)
+_TRUTH_TABLE_KEYS = frozenset(SOURCE_OF_TRUTH_SCHEMA["tables"])
+_TRUTH_TABLES_RE = re.compile(
+    r"\b(?:" + "|".join(map(re.escape, SOURCE_OF_TRUTH_SCHEMA["tables"])) + r")\b"
+)
+_TRUTH_COLUMN_SETS = {
+    table_name: frozenset(table_info["columns"])
+    for table_name, table_info in SOURCE_OF_TRUTH_SCHEMA["tables"].items()
 }
-
-_AGENT_SCHEMA_CACHE: dict[str, Any] | None = None
-_AGENT_SCHEMA_CACHE_CREATED_AT = 0.0
-_AGENT_SCHEMA_LOCK = Lock()
-_AGENT_SCHEMA_SOURCE = "unknown"
-_AGENT_SCHEMA_LAST_ERROR: str | None = None
-_AGENT_SCHEMA_LAST_GEMINI_ATTEMPT_AT = 0.0
-_AGENT_SCHEMA_LAST_GEMINI_SUCCESS_AT = 0.0
-_AGENT_SCHEMA_LAST_KNOWN_GOOD: dict[str, Any] | None = None
-_AGENT_SCHEMA_LAST_KNOWN_GOOD_CREATED_AT = 0.0
-
-
-class AgentSchemaError(RuntimeError):
-    pass
-
-
-class QueryPlanError(RuntimeError):
-    pass
-
-
-def isDatabaseQuestion(userText: str) -> bool:
-    if not userText:
-        return False
-    text = " ".join(userText.strip().lower().split())
-    if len(text) < 3:
-        return False
-
-    non_db_signals = (
-        "dinner table",
-        "table tennis",
-        "furniture",
-        "restaurant",
-        "movie route",
-        "bus route map image",
-    )
-    if any(signal in text for signal in non_db_signals):
-        return False
-
-    db_signals = (
-        "postgres",
-        "sql",
-        "query",
-        "schema",
-        "table",
-        "column",
-        "join",
-        "route_id",
-        "trip_id",
-        "stop_id",
-        "gtfs",
-        "arrival",
-        "departure",
-        "stop times",
-        "busiest stops",
-        "busiest routes",
-        "accessible stops",
-        "accessible trips",
-        "wheelchair",
-        "nearby stops",
-        "route details",
-        "stop details",
-        "how many people went to",
-    )
-    if any(signal in text for signal in db_signals):
-        return True
-
-    entity_tokens = {
+_AGENT_SCHEMA_TOP_KEYS = frozenset(
+    {"dialect", "tables", "joins", "query_templates", "display_templates", "constraints"}
+)
+_CONSTRAINTS_KEYS = frozenset({"max_limit", "require_limit", "no_select_star"})
+_DISPLAY_TEMPLATE_KEYS = frozenset(
+    {"key", "title_template", "columns", "row_id_field", "formatting"}
+)
+_DISPLAY_COLUMN_KEYS = frozenset({"name", "label"})
+_FORMATTING_KEYS = frozenset({"time_fields", "latlon_fields", "color_fields"})
+_QUERY_TEMPLATE_KEYS = frozenset(
+    {
+        "key",
+        "description",
+        "required_inputs",
+        "sql_template",
+        "params",
+        "default_limit",
+        "display_key",
+        "safety_notes",
+    }
+)
+_REQUIRED_INPUT_KEYS = frozenset({"name", "type", "notes"})
+_REQUIRED_INPUT_TYPES = frozenset({"string", "number", "enum", "latlon"})
+
+_REQUIRED_TEMPLATE_KEYS = frozenset(
+    {
+        "list_routes",
+        "route_details",
+        "list_stops",
+        "stop_details",
+        "stops_on_route",
+        "routes_serving_stop",
+        "arrivals_for_stop",
+        "busiest_stops",
+        "busiest_routes",
+        "accessible_stops",
+        "accessible_trips",
+    }
+)
+
+_NON_DB_SIGNALS = (
+    "dinner table",
+    "table tennis",
+    "furniture",
+    "restaurant",
+    "movie route",
+    "bus route map image",
+)
+_DB_SIGNALS = (
+    "postgres",
+    "sql",
+    "query",
+    "schema",
+    "table",
+    "column",
+    "join",
+    "route_id",
+    "trip_id",
+    "stop_id",
+    "gtfs",
+    "arrival",
+    "departure",
+    "stop times",
+    "busiest stops",
+    "busiest routes",
+    "accessible stops",
+    "accessible trips",
+    "wheelchair",
+    "nearby stops",
+    "route details",
+    "stop details",
+    "how many people went to",
+)
+# One C-level scan per signal list instead of a Python loop of substring checks.
+_NON_DB_SIGNAL_RE = re.compile("|".join(map(re.escape, _NON_DB_SIGNALS)))
+_DB_SIGNAL_RE = re.compile("|".join(map(re.escape, _DB_SIGNALS)))
+_ENTITY_TOKENS = frozenset(
+    {
         "route",
         "routes",
         "stop",
@@ -215,7 +241,9 @@ def isDatabaseQuestion(userText: str) -> bool:
         "nearby",
         "gtfs",
     }
-    intent_tokens = {
+)
+_INTENT_TOKENS = frozenset(
+    {
         "show",
         "list",
         "what",
@@ -237,11 +265,10 @@ def isDatabaseQuestion(userText: str) -> bool:
         "have",
         "has",
     }
-    token_set = set(re.findall(r"[a-z0-9_]+", text))
-    if token_set.intersection(entity_tokens) and token_set.intersection(intent_tokens):
-        return True
-
-    patterns = (
+)
+_DB_QUESTION_PATTERNS = tuple(
+    re.compile(pattern)
+    for pattern in (
         r"\blist\b.*\broutes?\b",
         r"\blist\b.*\bstops?\b",
         r"\bshow\b.*\broutes?\b",
@@ -266,100 +293,367 @@ def isDatabaseQuestion(userText: str) -> bool:
         r"\bnumber of\b.*\broutes?\b",
         r"\bnumber of\b.*\btrips?\b",
     )
-    return any(re.search(pattern, text) for pattern in patterns)
+)
+_TOKEN_RE = re.compile(r"[a-z0-9_]+")
+_PLACEHOLDER_RE = re.compile(r"\$(\d+)")
+_ROW_LIMIT_PARAM_NAMES = frozenset({"limit", "top_n", "n"})
+_STOP_NAME_PARAM_NAMES = frozenset({"stop_name", "stop_name_substring", "name_substring"})
+# Param names that read one extracted value as-is.
+_PARAM_EXTRACTED_KEYS = {
+    "route_type": "route_type",
+    "route_id": "route_id",
+    "route_short_name": "route_short_name",
+    "stop_id": "stop_id",
+    "lat": "lat",
+    "lon": "lon",
+    "lng": "lon",
+}
+_SELECT_STAR_RE = re.compile(r"\bselect\s+\*", re.IGNORECASE)
+_LIMIT_LEAST_RE = re.compile(r"\blimit\s+least\s*\(\s*\$(\d+)\s*,\s*(\d+)\s*\)", re.IGNORECASE)
+_LIMIT_PARAM_RE = re.compile(r"\blimit\s+\$(\d+)\b", re.IGNORECASE)
+_LIMIT_CONST_RE = re.compile(r"\blimit\s+(\d+)\b", re.IGNORECASE)
+# The three LIMIT forms above as one alternation, so a single pass finds them all.
+_LIMIT_CLAUSE_RE = re.compile(
+    r"\blimit\s+(?:least\s*\(\s*\$(\d+)\s*,\s*(\d+)\s*\)|\$(\d+)\b|(\d+)\b)",
+    re.IGNORECASE,
+)
+# Checked in order; the first rule with a matching signal and an available template wins.
+_TEMPLATE_INTENT_RULES: tuple[tuple[str, tuple[str, ...]], ...] = (
+    (
+        "stop_service_volume",
+        (
+            "how many people went to",
+            "how many people at",
+            "how many riders at",
+            "how many riders went to",
+            "how many went to",
+            "traffic at",
+        ),
+    ),
+    ("arrivals_for_stop", ("arrival", "arrivals", "departure", "departures", "schedule")),
+    ("routes_serving_stop", ("routes serving", "serve stop", "which routes stop")),
+    ("stops_on_route", ("stops on route", "stops for route", "route stops")),
+    ("busiest_stops", ("busiest stop", "busiest stops", "top stop", "top stops", "most used stop", "most used stops")),
+    ("busiest_routes", ("busiest route", "busiest routes", "top route", "top routes", "most used route", "most used routes")),
+    ("accessible_stops", ("accessible stops", "wheelchair stops")),
+    ("accessible_trips", ("accessible trips", "wheelchair trips")),
+    ("route_details", ("route details", "details for route", "route info")),
+    ("stop_details", ("stop details", "details for stop", "stop info")),
+    ("list_stops", ("nearby stops", "list stops", "show stops")),
+    ("list_routes", ("list routes", "show routes", "all routes")),
+)
+_TEMPLATE_SIGNAL_KEYS = {
+    signal: key for key, signals in reversed(_TEMPLATE_INTENT_RULES) for signal in signals
+}
+# A zero-width lookahead reports overlapping signals, so one scan finds every rule
+# that fires. Longer signals go first; no signal of one rule prefixes another rule's.
+_TEMPLATE_SIGNAL_RE = re.compile(
+    "(?=("
+    + "|".join(map(re.escape, sorted(_TEMPLATE_SIGNAL_KEYS, key=len, reverse=True)))
+    + "))"
+)
+# Plain substring markers without word boundaries; "arrival" also covers "arrivals".
+_SPECIFIC_INTENT_RE = re.compile(
+    "busiest|arrival|departure|accessible|accessibility|serving|details|nearby"
+)
+_HOW_MANY_PEOPLE_RE = re.compile(r"\bhow many\b.*\bpeople\b")
+_LOCATION_PREPOSITION_RE = re.compile(r"\b(?:at|to|for)\b")
+# One pass over a lowercased SQL template picks up every construct validation looks at.
+_SQL_TEMPLATE_TOKEN_RE = re.compile(
+    r"(?P<select_star>\bselect\s+\*)"
+    r"|(?P<limit_least>\blimit\s+least\s*\(\s*\$(?P<least_index>\d+)\s*,\s*(?P<least_bound>\d+)\s*\))"
+    r"|(?P<limit_param>\blimit\s+\$(?P<param_index>\d+)\b)"
+    r"|(?P<limit_const>\blimit\s+(?P<const_bound>\d+)\b)"
+    r"|(?P<column>\b(?P<qualifier>[a-z_][a-z0-9_]*)\.(?P<column_name>[a-z_][a-z0-9_]*)\b)"
+)
+# Applied to lowercased SQL only, so no IGNORECASE.
+_TABLE_ALIAS_RE = re.compile(
+    r"\b(?:from|join)\s+([a-z_][a-z0-9_]*)(?:\s+(?:as\s+)?([a-z_][a-z0-9_]*))?"
+)
+_RESERVED_ALIAS_WORDS = frozenset(
+    {"on", "where", "group", "order", "limit", "left", "inner", "right", "join"}
+)
+_QUOTED_VALUE_RE = re.compile(r'"([^"]+)"')
+_ROUTE_SHORT_NAME_RE = re.compile(r"\broute(?:\s+short\s+name)?\s*[:=]?\s*([a-z0-9_-]+)\b")
+_STOP_NAME_RE = re.compile(r"\bstop(?:\s+name)?\s*(?:contains|like|named)?\s*\"([^\"]+)\"", re.I)
+_TRAILING_LOCATION_RE = re.compile(
+    r"\b(?:to|at|for)\s+([A-Za-z0-9&'./\-\s]{2,}?)(?:[?.!,;:]\s*)?$",
+    re.I,
+)
+# Zero-width alternatives so one finditer pass sees the first match of every
+# kind; no two alternatives can match at the same position.
+_USER_VALUE_RE = re.compile(
+    r"(?=(?P<route_type>\broute[_ ]type\s*[:=]?\s*(?P<route_type_value>\d+)\b)"
+    r"|(?P<route_id>\broute[_ ]id\s*[:=]?\s*(?P<route_id_value>[a-z0-9_-]+)\b)"
+    r"|(?P<stop_id>\bstop[_ ]id\s*[:=]?\s*(?P<stop_id_value>[a-z0-9_-]+)\b)"
+    r"|(?P<lat>\blat(?:itude)?\s*[:=]?\s*(?P<lat_value>-?\d+(?:\.\d+)?))"
+    r"|(?P<lon>\b(?:lon|lng|longitude)\s*[:=]?\s*(?P<lon_value>-?\d+(?:\.\d+)?))"
+    r"|(?P<pair>(?P<pair_lat>-?\d+\.\d+)\s*,\s*(?P<pair_lon>-?\d+\.\d+))"
+    r"|(?P<radius>(?P<radius_value>\d+(?:\.\d+)?)\s*(?:km|kilometer|kilometers)\b)"
+    r"|(?P<top>\btop\s+(?P<top_value>\d+)\b)"
+    r"|(?P<limit>\blimit\s+(?P<limit_value>\d+)\b))"
+)
+
+# (query_template_map, display_template_map, query_plan_specs) derived from a cached schema.
+_TemplateMaps = tuple[dict[str, Any], dict[str, Any], dict[str, dict[str, Any]]]
 
 
-def getAgentSchema() -> dict[str, Any]:
-    global _AGENT_SCHEMA_CACHE, _AGENT_SCHEMA_CACHE_CREATED_AT
+class AgentSchemaError(RuntimeError):
+    pass
 
+
+class QueryPlanError(RuntimeError):
+    pass
+
+
+class _SchemaCache:
+    # Readers take no lock: each attribute is swapped atomically, and the schema,
+    # its template maps and its timestamp travel together in one tuple so they
+    # can never be observed out of step. Writers serialize on the RLock; a rebuild
+    # runs outside it, and concurrent misses wait on the leader's in-flight Future.
+    __slots__ = (
+        "entry",
+        "inflight",
+        "source",
+        "last_error",
+        "last_attempt",
+        "last_success",
+        "last_known_good",
+        "last_known_good_created_at",
+        "_lock",
+    )
+
+    def __init__(self) -> None:
+        self._lock = RLock()
+        self.clear()
+        self.source = "unknown"
+        self.last_error: str | None = None
+        self.last_attempt = 0.0
+        self.last_success = 0.0
+
+    def clear(self) -> None:
+        with self._lock:
+            self.entry: tuple[dict[str, Any], _TemplateMaps, float] | None = None
+            self.inflight: Future[dict[str, Any]] | None = None
+            self.last_known_good: dict[str, Any] | None = None
+            self.last_known_good_created_at = 0.0
+
+    def fresh_entry(self, ttl_seconds: int) -> tuple[dict[str, Any], _TemplateMaps, float] | None:
+        entry = self.entry
+        if entry is None or ttl_seconds <= 0 or time.time() - entry[2] > ttl_seconds:
+            return None
+        return entry
+
+
+_AGENT_SCHEMA_CACHE = _SchemaCache()
+
+
+@dataclass(frozen=True, slots=True)
+class _UserTextView:
+    """User text with the lowercase/normalized/tokenized forms computed once."""
+
+    raw: str
+    lower: str
+    normalized: str
+    tokens: frozenset[str]
+
+
+@lru_cache(maxsize=256)
+def _build_user_text_view(user_text: str) -> _UserTextView:
+    lower = user_text.lower()
+    normalized = " ".join(lower.split())
+    return _UserTextView(
+        raw=user_text,
+        lower=lower,
+        normalized=normalized,
+        tokens=frozenset(_TOKEN_RE.findall(normalized)),
+    )
+
+
+def _as_user_text_view(user_text: str | _UserTextView) -> _UserTextView:
+    if isinstance(user_text, _UserTextView):
+        return user_text
+    return _build_user_text_view(user_text)
+
+
+def isDatabaseQuestion(userText: str | _UserTextView) -> bool:
+    if not userText:
+        return False
+    if isinstance(userText, _UserTextView):
+        userText = userText.raw
+    return _is_database_question(userText)
+
+
+@lru_cache(maxsize=1024)
+def _is_database_question(user_text: str) -> bool:
+    # Retries and suggestion buttons resend identical text; classify each once.
+    view = _build_user_text_view(user_text)
+    text = view.normalized
+    if len(text) < 3:
+        return False
+
+    if _NON_DB_SIGNAL_RE.search(text):
+        return False
+    if _DB_SIGNAL_RE.search(text):
+        return True
+
+    token_set = view.tokens
+    if not token_set.isdisjoint(_ENTITY_TOKENS) and not token_set.isdisjoint(_INTENT_TOKENS):
+        return True
+
+    # No phrase pattern can match fewer than eight characters.
+    if len(text) < 8:
+        return False
+    return any(pattern.search(text) for pattern in _DB_QUESTION_PATTERNS)
+
+
+def getAgentSchema() -> dict[str, Any]:
+    # The returned schema is shared across requests and must be treated as read-only.
+    cache = _AGENT_SCHEMA_CACHE
     ttl_seconds = _read_int_env("SCHEMA_CACHE_SECONDS", 300)
-    now = time.time()
 
-    with _AGENT_SCHEMA_LOCK:
-        if (
-            _AGENT_SCHEMA_CACHE is not None
-            and ttl_seconds > 0
-            and now - _AGENT_SCHEMA_CACHE_CREATED_AT <= ttl_seconds
-        ):
-            return copy.deepcopy(_AGENT_SCHEMA_CACHE)
+    entry = cache.fresh_entry(ttl_seconds)
+    if entry is not None:
+        return entry[0]
+
+    with cache._lock:
+        # Another request may have rebuilt the schema while we waited.
+        entry = cache.fresh_entry(ttl_seconds)
+        if entry is not None:
+            return entry[0]
+        inflight = cache.inflight
+        if inflight is None:
+            inflight = cache.inflight = Future()
+            is_leader = True
+        else:
+            is_leader = False
+    if not is_leader:
+        # Waiters share the leader's schema or its AgentSchemaError.
+        return inflight.result()
 
-    schema = _build_agent_schema_uncached()
-    with _AGENT_SCHEMA_LOCK:
-        _AGENT_SCHEMA_CACHE = copy.deepcopy(schema)
-        _AGENT_SCHEMA_CACHE_CREATED_AT = time.time()
-    return copy.deepcopy(schema)
+    try:
+        schema = copy.deepcopy(_build_agent_schema_uncached())
+        template_maps = _build_template_maps(schema)
+    except BaseException as exc:
+        with cache._lock:
+            if cache.inflight is inflight:
+                cache.inflight = None
+        inflight.set_exception(exc)
+        raise
+    with cache._lock:
+        # A clear() during the build drops this Future, so the result is not stored.
+        if cache.inflight is inflight:
+            cache.entry = (schema, template_maps, time.time())
+            cache.inflight = None
+    inflight.set_result(schema)
+    return schema
 
 
 def getAgentSchemaStatus() -> dict[str, Any]:
-    with _AGENT_SCHEMA_LOCK:
-        return {
-            "source": _AGENT_SCHEMA_SOURCE,
-            "last_error": _AGENT_SCHEMA_LAST_ERROR,
-            "last_gemini_attempt_at": _AGENT_SCHEMA_LAST_GEMINI_ATTEMPT_AT,
-            "last_gemini_success_at": _AGENT_SCHEMA_LAST_GEMINI_SUCCESS_AT,
-            "cache_age_seconds": max(0.0, time.time() - _AGENT_SCHEMA_CACHE_CREATED_AT)
-            if _AGENT_SCHEMA_CACHE_CREATED_AT
-            else None,
-            "last_known_good_age_seconds": max(
-                0.0,
-                time.time() - _AGENT_SCHEMA_LAST_KNOWN_GOOD_CREATED_AT,
-            )
-            if _AGENT_SCHEMA_LAST_KNOWN_GOOD_CREATED_AT
-            else None,
-        }
+    cache = _AGENT_SCHEMA_CACHE
+    entry = cache.entry
+    last_known_good_created_at = cache.last_known_good_created_at
+    now = time.time()
+    return {
+        "source": cache.source,
+        "last_error": cache.last_error,
+        "last_gemini_attempt_at": cache.last_attempt,
+        "last_gemini_success_at": cache.last_success,
+        "cache_age_seconds": max(0.0, now - entry[2]) if entry is not None else None,
+        "last_known_good_age_seconds": max(0.0, now - last_known_good_created_at)
+        if last_known_good_created_at
+        else None,
+    }
 
 
 def clearAgentSchemaCache() -> None:
-    global _AGENT_SCHEMA_CACHE, _AGENT_SCHEMA_CACHE_CREATED_AT
-    global _AGENT_SCHEMA_LAST_KNOWN_GOOD, _AGENT_SCHEMA_LAST_KNOWN_GOOD_CREATED_AT
-    with _AGENT_SCHEMA_LOCK:
-        _AGENT_SCHEMA_CACHE = None
-        _AGENT_SCHEMA_CACHE_CREATED_AT = 0.0
-        _AGENT_SCHEMA_LAST_KNOWN_GOOD = None
-        _AGENT_SCHEMA_LAST_KNOWN_GOOD_CREATED_AT = 0.0
+    _AGENT_SCHEMA_CACHE.clear()
+
+
+def _build_template_maps(agent_schema: dict[str, Any]) -> _TemplateMaps:
+    query_templates = agent_schema.get("query_templates", [])
+    query_map = {
+        template.get("key"): template
+        for template in (query_templates if isinstance(query_templates, list) else [])
+        if isinstance(template, dict) and isinstance(template.get("key"), str)
+    }
+    display_templates = agent_schema.get("display_templates", [])
+    display_map: dict[str, Any] = {}
+    for template in display_templates if isinstance(display_templates, list) else []:
+        if isinstance(template, dict) and isinstance(template.get("key"), str):
+            display_map.setdefault(template["key"], template)
+    plan_specs = {key: _build_query_plan_spec(template) for key, template in query_map.items()}
+    return query_map, display_map, plan_specs
+
+
+def _build_query_plan_spec(template: dict[str, Any]) -> dict[str, Any]:
+    required_inputs = template.get("required_inputs", [])
+    required_groups: list[frozenset[str]] = []
+    for item in required_inputs if isinstance(required_inputs, list) else []:
+        if not isinstance(item, dict):
+            continue
+        name_value = item.get("name")
+        if not isinstance(name_value, str):
+            continue
+        group = frozenset(part.strip() for part in name_value.split("|") if part.strip())
+        if group:
+            required_groups.append(group)
+    params = template.get("params", [])
+    return {
+        "required_groups": tuple(required_groups),
+        "params": tuple(params) if isinstance(params, list) else (),
+        "sql_template": str(template.get("sql_template", "")).strip(),
+        "display_key": template.get("display_key"),
+    }
+
+
+def _get_template_maps(agent_schema: dict[str, Any]) -> _TemplateMaps:
+    entry = _AGENT_SCHEMA_CACHE.entry
+    if entry is not None and agent_schema is entry[0]:
+        return entry[1]
+    return _build_template_maps(agent_schema)
 
 
 def _store_last_known_good_agent_schema(schema: dict[str, Any]) -> None:
-    global _AGENT_SCHEMA_LAST_KNOWN_GOOD, _AGENT_SCHEMA_LAST_KNOWN_GOOD_CREATED_AT
-    with _AGENT_SCHEMA_LOCK:
-        _AGENT_SCHEMA_LAST_KNOWN_GOOD = copy.deepcopy(schema)
-        _AGENT_SCHEMA_LAST_KNOWN_GOOD_CREATED_AT = time.time()
+    cache = _AGENT_SCHEMA_CACHE
+    snapshot = copy.deepcopy(schema)
+    with cache._lock:
+        cache.last_known_good = snapshot
+        cache.last_known_good_created_at = time.time()
 
 
 def _get_last_known_good_agent_schema() -> dict[str, Any] | None:
-    with _AGENT_SCHEMA_LOCK:
-        if _AGENT_SCHEMA_LAST_KNOWN_GOOD is None:
-            return None
-        return copy.deepcopy(_AGENT_SCHEMA_LAST_KNOWN_GOOD)
+    last_known_good = _AGENT_SCHEMA_CACHE.last_known_good
+    if last_known_good is None:
+        return None
+    return copy.deepcopy(last_known_good)
 
 
 def _build_agent_schema_uncached() -> dict[str, Any]:
-    global _AGENT_SCHEMA_SOURCE, _AGENT_SCHEMA_LAST_ERROR
-    global _AGENT_SCHEMA_LAST_GEMINI_ATTEMPT_AT, _AGENT_SCHEMA_LAST_GEMINI_SUCCESS_AT
-
-    _AGENT_SCHEMA_LAST_GEMINI_ATTEMPT_AT = time.time()
+    cache = _AGENT_SCHEMA_CACHE
+    cache.last_attempt = time.time()
     try:
-        raw_schema = proposeAgentSchemaFromTruth(SOURCE_OF_TRUTH_SCHEMA)
+        raw_schema, raw_schema_text = proposeAgentSchemaFromTruth(SOURCE_OF_TRUTH_SCHEMA)
     except AgentSchemaError as exc:
         cached_schema = _get_last_known_good_agent_schema()
         if cached_schema is not None:
-            _AGENT_SCHEMA_SOURCE = "cached_last_good"
-            _AGENT_SCHEMA_LAST_ERROR = (
+            cache.source = "cached_last_good"
+            cache.last_error = (
                 f"Gemini schema generation failed: {exc}. Using last known-good cached schema."
             )
             return cached_schema
-        _AGENT_SCHEMA_SOURCE = "unavailable"
-        _AGENT_SCHEMA_LAST_ERROR = (
+        cache.source = "unavailable"
+        cache.last_error = (
             f"Gemini schema generation failed: {exc}. No cached schema is available."
         )
-        raise AgentSchemaError(_AGENT_SCHEMA_LAST_ERROR)
+        raise AgentSchemaError(cache.last_error)
 
     raw_schema = _normalize_agent_schema(raw_schema, SOURCE_OF_TRUTH_SCHEMA)
     errors = _validate_agent_schema(raw_schema, SOURCE_OF_TRUTH_SCHEMA, strict_templates=True)
     if not errors:
-        _AGENT_SCHEMA_SOURCE = "gemini"
-        _AGENT_SCHEMA_LAST_ERROR = None
-        _AGENT_SCHEMA_LAST_GEMINI_SUCCESS_AT = time.time()
+        cache.source = "gemini"
+        cache.last_error = None
+        cache.last_success = time.time()
         _store_last_known_good_agent_schema(raw_schema)
         return raw_schema
 
@@ -367,20 +661,23 @@ def _build_agent_schema_uncached() -> dict[str, Any]:
     try:
         repair_schema = _propose_repaired_agent_schema(
             SOURCE_OF_TRUTH_SCHEMA,
-            previous_schema=raw_schema,
+            previous_schema_json=raw_schema_text,
             validation_errors=errors,
         )
     except AgentSchemaError as exc:
         repair_error_text = str(exc)
-        repair_schema = {}
-    repair_schema = _normalize_agent_schema(repair_schema, SOURCE_OF_TRUTH_SCHEMA)
-    repair_errors = _validate_agent_schema(repair_schema, SOURCE_OF_TRUTH_SCHEMA, strict_templates=True)
-    if not repair_errors:
-        _AGENT_SCHEMA_SOURCE = "gemini_repair"
-        _AGENT_SCHEMA_LAST_ERROR = None
-        _AGENT_SCHEMA_LAST_GEMINI_SUCCESS_AT = time.time()
-        _store_last_known_good_agent_schema(repair_schema)
-        return repair_schema
+    else:
+        # Only validate when the repair call produced something to validate.
+        repair_schema = _normalize_agent_schema(repair_schema, SOURCE_OF_TRUTH_SCHEMA)
+        repair_errors = _validate_agent_schema(
+            repair_schema, SOURCE_OF_TRUTH_SCHEMA, strict_templates=True, early_exit=True
+        )
+        if not repair_errors:
+            cache.source = "gemini_repair"
+            cache.last_error = None
+            cache.last_success = time.time()
+            _store_last_known_good_agent_schema(repair_schema)
+            return repair_schema
 
     primary_errors = "; ".join(errors[:3]) if errors else "unknown validation error"
     validation_error_text = (
@@ -392,36 +689,31 @@ def _build_agent_schema_uncached() -> dict[str, Any]:
     )
     cached_schema = _get_last_known_good_agent_schema()
     if cached_schema is not None:
-        _AGENT_SCHEMA_SOURCE = "cached_last_good"
-        _AGENT_SCHEMA_LAST_ERROR = f"{validation_error_text} Using last known-good cached schema."
+        cache.source = "cached_last_good"
+        cache.last_error = f"{validation_error_text} Using last known-good cached schema."
         return cached_schema
 
-    _AGENT_SCHEMA_SOURCE = "unavailable"
-    if repair_error_text:
-        _AGENT_SCHEMA_LAST_ERROR = (
-            "Gemini schema failed validation; "
-            f"repair failed: {repair_error_text}; "
-            f"validation details: {primary_errors}. No cached schema is available."
-        )
-    else:
-        _AGENT_SCHEMA_LAST_ERROR = (
-            f"Gemini schema failed validation: {primary_errors}. No cached schema is available."
-        )
-    raise AgentSchemaError(_AGENT_SCHEMA_LAST_ERROR)
+    cache.source = "unavailable"
+    cache.last_error = f"{validation_error_text} No cached schema is available."
+    raise AgentSchemaError(cache.last_error)
 
 
-def proposeAgentSchemaFromTruth(truthSchema: dict[str, Any]) -> dict[str, Any]:
-    prompt = _build_schema_prompt(truthSchema)
+def proposeAgentSchemaFromTruth(truthSchema: dict[str, Any]) -> tuple[dict[str, Any], str]:
+    """Return the parsed schema and the JSON text Gemini emitted for it."""
+    if truthSchema is SOURCE_OF_TRUTH_SCHEMA:
+        prompt = _source_schema_prompt()
+    else:
+        prompt = _build_schema_prompt(truthSchema)
     payload = _call_gemini_json(prompt)
-    return _extract_json_object(payload)
+    return _extract_json_object_with_text(payload)
 
 
 def _propose_repaired_agent_schema(
     truth_schema: dict[str, Any],
-    previous_schema: dict[str, Any],
+    previous_schema_json: str,
     validation_errors: list[str],
 ) -> dict[str, Any]:
-    prompt = _build_repair_prompt(truth_schema, previous_schema, validation_errors)
+    prompt = _build_repair_prompt(truth_schema, previous_schema_json, validation_errors)
     payload = _call_gemini_json(prompt)
     return _extract_json_object(payload)
 
@@ -434,59 +726,53 @@ def proposeQueryPlan(userText: str, agentSchema: dict[str, Any]) -> dict[str, An
     if not isinstance(templates, list) or not templates:
         raise QueryPlanError("agentSchema.query_templates must contain at least one template.")
 
-    max_limit = _read_int_env("MAX_RESULT_ROWS", 50)
+    max_limit = _max_result_rows()
     gemini_plan = _propose_query_plan_from_headers(userText, max_limit)
-    gemini_not_possible_plan: dict[str, Any] | None = None
     if gemini_plan is not None and gemini_plan.get("template_key") != "gemini_not_possible":
         return gemini_plan
-    if gemini_plan is not None and gemini_plan.get("template_key") == "gemini_not_possible":
-        gemini_not_possible_plan = gemini_plan
 
-    template_map = {
-        template.get("key"): template
-        for template in templates
-        if isinstance(template, dict) and isinstance(template.get("key"), str)
+    local_plan = _propose_query_plan_from_templates(userText, agentSchema, max_limit)
+    if local_plan is not None:
+        return local_plan
+    if gemini_plan is not None:
+        return gemini_plan
+    return {
+        "clarifying_question": (
+            "What GTFS query do you want? For example: list routes, stop details, "
+            "arrivals for stop_id, busiest stops, or nearby stops."
+        ),
+        "sql": None,
+        "params": [],
+        "display_key": None,
+        "safety": {"row_limit": 0},
     }
-    template_key = _choose_template_key(userText, template_map)
+
+
+def _propose_query_plan_from_templates(
+    user_text: str,
+    agent_schema: dict[str, Any],
+    max_limit: int,
+) -> dict[str, Any] | None:
+    template_map, _, plan_specs = _get_template_maps(agent_schema)
+    view = _as_user_text_view(user_text)
+    template_key = _choose_template_key(view, template_map)
     if not template_key:
-        if gemini_not_possible_plan is not None:
-            return gemini_not_possible_plan
-        return {
-            "clarifying_question": (
-                "What GTFS query do you want? For example: list routes, stop details, "
-                "arrivals for stop_id, busiest stops, or nearby stops."
-            ),
-            "sql": None,
-            "params": [],
-            "display_key": None,
-            "safety": {"row_limit": 0},
-        }
+        return None
 
     template = template_map[template_key]
-    extracted = _extract_user_values(userText)
+    plan_spec = plan_specs[template_key]
+    extracted = _extract_user_values(view)
     row_limit = _compute_row_limit(extracted, template, max_limit)
 
-    required_inputs = template.get("required_inputs", [])
-    required_groups: list[set[str]] = []
-    for item in required_inputs:
-        if not isinstance(item, dict):
-            continue
-        name_value = item.get("name")
-        if not isinstance(name_value, str):
-            continue
-        group = {part.strip() for part in name_value.split("|") if part.strip()}
-        if group:
-            required_groups.append(group)
-
     params_list: list[Any] = []
     param_map: dict[str, Any] = {}
-    for param_name in template.get("params", []):
+    for param_name in plan_spec["params"]:
         value = _resolve_param_value(param_name, extracted, row_limit)
         params_list.append(value)
         param_map[param_name] = value
 
     missing_groups: list[str] = []
-    for group in required_groups:
+    for group in plan_spec["required_groups"]:
         has_any = any(
             _has_required_value(param_map.get(name)) or _has_required_value(extracted.get(name))
             for name in group
@@ -500,11 +786,11 @@ def proposeQueryPlan(userText: str, agentSchema: dict[str, Any]) -> dict[str, An
             "clarifying_question": question,
             "sql": None,
             "params": [],
-            "display_key": template.get("display_key"),
+            "display_key": plan_spec["display_key"],
             "safety": {"row_limit": row_limit},
         }
 
-    sql = str(template.get("sql_template", "")).strip()
+    sql = plan_spec["sql_template"]
     if not sql:
         raise QueryPlanError(f"Template '{template_key}' has empty sql_template.")
 
@@ -514,7 +800,7 @@ def proposeQueryPlan(userText: str, agentSchema: dict[str, Any]) -> dict[str, An
         "sql": sql,
         "params": params_list,
         "param_map": param_map,
-        "display_key": template.get("display_key"),
+        "display_key": plan_spec["display_key"],
         "clarifying_question": None,
         "safety": {
             "row_limit": row_limit,
@@ -600,8 +886,7 @@ def _propose_query_plan_from_headers(user_text: str, max_limit: int) -> dict[str
         SOURCE_OF_TRUTH_SCHEMA,
         "gemini_generated",
     )
-    placeholders = [int(value) for value in re.findall(r"\$(\d+)", sql)]
-    if placeholders and max(placeholders) > len(normalized_params):
+    if _max_placeholder_index(sql) > len(normalized_params):
         return _not_possible_query_plan(
             max_limit,
             reason=decision_reason or "SQL placeholders exceed params.",
@@ -664,14 +949,17 @@ def executeParameterizedQuery(query_plan: dict[str, Any]) -> dict[str, Any]:
         raise QueryPlanError("Query plan params must be a list.")
 
     converted_sql, bind_params = _convert_postgres_params(sql, params)
-    row_limit = int(query_plan.get("safety", {}).get("row_limit", _read_int_env("MAX_RESULT_ROWS", 50)))
-    row_limit = max(1, min(row_limit, _read_int_env("MAX_RESULT_ROWS", 50)))
+    max_rows = _max_result_rows()
+    row_limit = int(query_plan.get("safety", {}).get("row_limit", max_rows))
+    row_limit = max(1, min(row_limit, max_rows))
 
     try:
         engine = get_engine()
         with engine.connect() as connection:
-            result = connection.execute(text(converted_sql), bind_params)
-            rows = [dict(row._mapping) for row in result]
+            result = connection.execute(_text_clause(converted_sql), bind_params)
+            # Stop reading the cursor at row_limit instead of materializing and trimming.
+            keys = tuple(result.keys())
+            rows = [dict(zip(keys, row)) for row in islice(result, row_limit)]
     except (SQLAlchemyError, RuntimeError) as exc:
         return {
             "executed": True,
@@ -682,9 +970,6 @@ def executeParameterizedQuery(query_plan: dict[str, Any]) -> dict[str, Any]:
             "error": str(exc),
         }
 
-    if len(rows) > row_limit:
-        rows = rows[:row_limit]
-
     columns = list(rows[0].keys()) if rows else []
     return {
         "executed": True,
@@ -702,12 +987,8 @@ def renderDisplayPayload(
     agent_schema: dict[str, Any],
 ) -> dict[str, Any]:
     display_key = query_plan.get("display_key")
-    templates = agent_schema.get("display_templates", [])
-    template = None
-    for item in templates:
-        if isinstance(item, dict) and item.get("key") == display_key:
-            template = item
-            break
+    _, display_map, _ = _get_template_maps(agent_schema)
+    template = display_map.get(display_key) if isinstance(display_key, str) else None
 
     if template is None:
         return {
@@ -720,14 +1001,10 @@ def renderDisplayPayload(
         }
 
     columns = template.get("columns", [])
-    display_rows = []
-    for row in rows:
-        display_row = {}
-        for column in columns:
-            name = column.get("name")
-            if isinstance(name, str):
-                display_row[name] = row.get(name)
-        display_rows.append(display_row)
+    column_names = tuple(
+        name for name in (column.get("name") for column in columns) if isinstance(name, str)
+    )
+    display_rows = _project_display_rows(rows, column_names)
 
     title_template = str(template.get("title_template", "Query Results"))
     title_context = {"row_count": len(rows)}
@@ -751,16 +1028,94 @@ def renderDisplayPayload(
     }
 
 
+def _project_display_rows(
+    rows: list[dict[str, Any]],
+    column_names: tuple[str, ...],
+) -> list[dict[str, Any]]:
+    if not column_names:
+        return [{} for _ in rows]
+    getter = itemgetter(*column_names)
+    single_column = len(column_names) == 1
+    display_rows = []
+    for row in rows:
+        try:
+            values = getter(row)
+        except KeyError:
+            # Rows missing a template column fall back to None for that column.
+            display_rows.append({name: row.get(name) for name in column_names})
+            continue
+        if single_column:
+            values = (values,)
+        display_rows.append(dict(zip(column_names, values)))
+    return display_rows
+
+
+_SETUP_MANDATE_TEXT = (
+    "MANDATORY: YOU MUST ADHERE EXACTLY TO OUR SETUP, CONTRACT SHAPE, AND SAFETY RULES.\n"
+    "MANDATORY: DO NOT INVENT TABLES, COLUMNS, JOINS, OR EXTRA KEYS.\n"
+    "MANDATORY: IF YOU CANNOT COMPLY EXACTLY, RETURN THE SPECIFIED JSON WITH A SAFE FAILURE REASON."
+)
+_DATASET_CONTEXT_TEXT = (
+    "Dataset semantics:\n"
+    "- routes = route definitions.\n"
+    "- trips = route-level trip/ticket records; each trip belongs to one route via trips.route_id.\n"
+    "- stop_times = stop events for each trip (arrival/departure/sequence), linking trips to stops.\n"
+    "- stops = stop metadata.\n"
+    "- routes do not connect directly to stops; derive route stops via routes -> trips -> stop_times -> stops.\n"
+    "- There are no fare, payment, or rider-count transaction tables in this dataset."
+)
+# Static leading text of the per-request planner prompts.
+_QUERY_FEASIBILITY_PROMPT_HEAD = (
+    f"{_SETUP_MANDATE_TEXT}\n"
+    "You are a fast feasibility checker for GTFS SQL over Postgres.\n"
+    "Decide if the user request can be answered using ONLY the available tables, columns, and joins.\n"
+    f"{_DATASET_CONTEXT_TEXT}\n"
+    "Return JSON only with this exact shape:\n"
+    "{"
+    '"possible": boolean,'
+    '"reason": string'
+    "}\n"
+    "Rules:\n"
+    "1) Be conservative. If unsure, return possible=false.\n"
+    "2) Do not generate SQL in this step.\n"
+    "3) Only mark possible=true if the answer can be produced from truthSchema data.\n"
+    "4) Keep possible and reason consistent. If reason says the answer can be determined "
+    "from available columns, possible must be true.\n"
+)
+_QUERY_SQL_PROMPT_HEAD = (
+    f"{_SETUP_MANDATE_TEXT}\n"
+    "You are a Postgres query generator over GTFS data.\n"
+    f"{_DATASET_CONTEXT_TEXT}\n"
+    "Return JSON only with this exact shape:\n"
+    "{"
+    '"sql": string,'
+    '"params": [any],'
+    '"row_limit": number,'
+    '"reason": string'
+    "}\n"
+    "Rules:\n"
+    "1) sql must be SELECT-only, parameterized with $1,$2..., and must include LIMIT.\n"
+    "2) Use only tables/columns and join keys from truthSchema.\n"
+    "3) Never use SELECT *.\n"
+    "4) LIMIT must be bounded and <= max_limit.\n"
+    "5) If stop name matching is used, use ILIKE with concatenated wildcards.\n"
+)
+
+
+@lru_cache(maxsize=1)
+def _source_schema_prompt() -> str:
+    # The schema prompt has no per-request input, so SOURCE_OF_TRUTH_SCHEMA's is built once.
+    return _build_schema_prompt(SOURCE_OF_TRUTH_SCHEMA)
+
+
 def _build_schema_prompt(truth_schema: dict[str, Any]) -> str:
-    truth_json = json.dumps(truth_schema, ensure_ascii=True)
-    setup_mandate = _build_setup_mandate_text()
-    dataset_context = _build_dataset_context_text()
+    truth_json = _serialize_truth_schema(truth_schema)
     return (
-        f"{setup_mandate}\n"
+        f"{_SETUP_MANDATE_TEXT}\n"
         "You are generating a STRICT machine-readable agent schema for GTFS query planning.\n"
         "Use only tables/columns/joins from truthSchema. Do not invent fields.\n"
         "Return JSON only, no markdown, no comments.\n"
-        f"{dataset_context}\n"
+        f"{_DATASET_CONTEXT_TEXT}\n"
         "Contract:\n"
         "{"
         '"dialect":"postgres",'
@@ -786,20 +1141,18 @@ def _build_schema_prompt(truth_schema: dict[str, Any]) -> str:
 
 def _build_repair_prompt(
     truth_schema: dict[str, Any],
-    previous_schema: dict[str, Any],
+    previous_json: str,
     validation_errors: list[str],
 ) -> str:
-    truth_json = json.dumps(truth_schema, ensure_ascii=True)
-    previous_json = json.dumps(previous_schema, ensure_ascii=True)
+    # previous_json is Gemini's own output, fed back verbatim instead of re-serialized.
+    truth_json = _serialize_truth_schema(truth_schema)
     error_json = json.dumps(validation_errors, ensure_ascii=True)
-    setup_mandate = _build_setup_mandate_text()
-    dataset_context = _build_dataset_context_text()
     return (
-        f"{setup_mandate}\n"
+        f"{_SETUP_MANDATE_TEXT}\n"
         "Repair the previous agent schema JSON.\n"
         "Return JSON only.\n"
         "Do not invent new tables/columns.\n"
-        f"{dataset_context}\n"
+        f"{_DATASET_CONTEXT_TEXT}\n"
         f"truthSchema={truth_json}\n"
         f"validationErrors={error_json}\n"
         f"previousSchema={previous_json}"
@@ -807,40 +1160,31 @@ def _build_repair_prompt(
 
 
 def _build_query_feasibility_prompt(user_text: str, truth_schema: dict[str, Any]) -> str:
-    truth_json = json.dumps(
-        {
-            "dialect": truth_schema.get("dialect"),
-            "tables": truth_schema.get("tables"),
-            "joins": truth_schema.get("joins"),
-        },
-        ensure_ascii=True,
-    )
+    truth_json = _serialize_query_plan_truth(truth_schema)
+    request_json = json.dumps(user_text, ensure_ascii=True)
+    return f"{_QUERY_FEASIBILITY_PROMPT_HEAD}userRequest={request_json}\ntruthSchema={truth_json}"
+
+
+def _build_query_sql_prompt(user_text: str, truth_schema: dict[str, Any], max_limit: int) -> str:
+    truth_json = _serialize_query_plan_truth(truth_schema)
     request_json = json.dumps(user_text, ensure_ascii=True)
-    setup_mandate = _build_setup_mandate_text()
-    dataset_context = _build_dataset_context_text()
     return (
-        f"{setup_mandate}\n"
-        "You are a fast feasibility checker for GTFS SQL over Postgres.\n"
-        "Decide if the user request can be answered using ONLY the available tables, columns, and joins.\n"
-        f"{dataset_context}\n"
-        "Return JSON only with this exact shape:\n"
-        "{"
-        '"possible": boolean,'
-        '"reason": string'
-        "}\n"
-        "Rules:\n"
-        "1) Be conservative. If unsure, return possible=false.\n"
-        "2) Do not generate SQL in this step.\n"
-        "3) Only mark possible=true if the answer can be produced from truthSchema data.\n"
-        "4) Keep possible and reason consistent. If reason says the answer can be determined "
-        "from available columns, possible must be true.\n"
+        f"{_QUERY_SQL_PROMPT_HEAD}max_limit={max_limit}\n"
         f"userRequest={request_json}\n"
         f"truthSchema={truth_json}"
     )
 
 
-def _build_query_sql_prompt(user_text: str, truth_schema: dict[str, Any], max_limit: int) -> str:
-    truth_json = json.dumps(
+def _serialize_truth_schema(truth_schema: dict[str, Any]) -> str:
+    if truth_schema is SOURCE_OF_TRUTH_SCHEMA:
+        return _SOURCE_TRUTH_JSON
+    return json.dumps(truth_schema, ensure_ascii=True)
+
+
+def _serialize_query_plan_truth(truth_schema: dict[str, Any]) -> str:
+    if truth_schema is SOURCE_OF_TRUTH_SCHEMA:
+        return _QUERY_PLAN_TRUTH_JSON
+    return json.dumps(
         {
             "dialect": truth_schema.get("dialect"),
             "tables": truth_schema.get("tables"),
@@ -848,50 +1192,101 @@ def _build_query_sql_prompt(user_text: str, truth_schema: dict[str, Any], max_li
         },
         ensure_ascii=True,
     )
-    request_json = json.dumps(user_text, ensure_ascii=True)
-    setup_mandate = _build_setup_mandate_text()
-    dataset_context = _build_dataset_context_text()
-    return (
-        f"{setup_mandate}\n"
-        "You are a Postgres query generator over GTFS data.\n"
-        f"{dataset_context}\n"
-        "Return JSON only with this exact shape:\n"
-        "{"
-        '"sql": string,'
-        '"params": [any],'
-        '"row_limit": number,'
-        '"reason": string'
-        "}\n"
-        "Rules:\n"
-        "1) sql must be SELECT-only, parameterized with $1,$2..., and must include LIMIT.\n"
-        "2) Use only tables/columns and join keys from truthSchema.\n"
-        "3) Never use SELECT *.\n"
-        "4) LIMIT must be bounded and <= max_limit.\n"
-        "5) If stop name matching is used, use ILIKE with concatenated wildcards.\n"
-        f"max_limit={max_limit}\n"
-        f"userRequest={request_json}\n"
-        f"truthSchema={truth_json}"
-    )
 
 
-def _build_setup_mandate_text() -> str:
-    return (
-        "MANDATORY: YOU MUST ADHERE EXACTLY TO OUR SETUP, CONTRACT SHAPE, AND SAFETY RULES.\n"
-        "MANDATORY: DO NOT INVENT TABLES, COLUMNS, JOINS, OR EXTRA KEYS.\n"
-        "MANDATORY: IF YOU CANNOT COMPLY EXACTLY, RETURN THE SPECIFIED JSON WITH A SAFE FAILURE REASON."
-    )
+class _GeminiRateLimiter:
+    """Token buckets for Gemini requests-per-minute and tokens-per-minute budgets."""
+
+    def __init__(self) -> None:
+        self._lock = Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            self._request_budget: float | None = None
+            self._token_budget: float | None = None
+            self._updated_at = time.monotonic()
+            self._blocked_until = 0.0
+
+    def acquire(self, estimated_tokens: int) -> None:
+        rpm_limit = _read_int_env("GEMINI_RPM_LIMIT", 0)
+        tpm_limit = _read_int_env("GEMINI_TPM_LIMIT", 0)
+        if rpm_limit <= 0 and tpm_limit <= 0 and self._blocked_until <= time.monotonic():
+            return
+        while True:
+            with self._lock:
+                wait_seconds = self._reserve(rpm_limit, tpm_limit, estimated_tokens)
+            if wait_seconds <= 0:
+                return
+            time.sleep(wait_seconds)
+
+    def block_for(self, seconds: float) -> None:
+        with self._lock:
+            self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+
+    def _reserve(self, rpm_limit: int, tpm_limit: int, estimated_tokens: int) -> float:
+        now = time.monotonic()
+        if now < self._blocked_until:
+            return self._blocked_until - now
+        elapsed = max(0.0, now - self._updated_at)
+        self._updated_at = now
+
+        request_budget = self._refill(self._request_budget, rpm_limit, elapsed)
+        token_budget = self._refill(self._token_budget, tpm_limit, elapsed)
+        token_cost = float(min(max(1, estimated_tokens), tpm_limit)) if tpm_limit > 0 else 0.0
+
+        wait_seconds = 0.0
+        if rpm_limit > 0 and request_budget < 1.0:
+            wait_seconds = (1.0 - request_budget) * 60.0 / rpm_limit
+        if tpm_limit > 0 and token_budget < token_cost:
+            wait_seconds = max(wait_seconds, (token_cost - token_budget) * 60.0 / tpm_limit)
+
+        if wait_seconds <= 0:
+            if rpm_limit > 0:
+                request_budget -= 1.0
+            if tpm_limit > 0:
+                token_budget -= token_cost
+        self._request_budget = request_budget if rpm_limit > 0 else None
+        self._token_budget = token_budget if tpm_limit > 0 else None
+        return wait_seconds
+
+    @staticmethod
+    def _refill(budget: float | None, limit: int, elapsed: float) -> float:
+        if limit <= 0:
+            return 0.0
+        if budget is None:
+            return float(limit)
+        return min(float(limit), budget + elapsed * limit / 60.0)
+
+
+_GEMINI_RATE_LIMITER = _GeminiRateLimiter()
+_GEMINI_RETRY_STATUS_CODES = frozenset({408, 429, 500, 502, 503, 504})
+_GEMINI_BACKOFF_BASE_SECONDS = 0.5
+_GEMINI_BACKOFF_CAP_SECONDS = 8.0
+
+
+def _retry_delay_seconds(attempt: int, retry_after: float | None = None) -> float:
+    if retry_after is not None:
+        return min(_GEMINI_BACKOFF_CAP_SECONDS, retry_after)
+    delay = min(_GEMINI_BACKOFF_CAP_SECONDS, _GEMINI_BACKOFF_BASE_SECONDS * 2 ** (attempt - 1))
+    return delay * random.uniform(0.75, 1.25)
+
+
+def _parse_retry_after(exc: urlerror.HTTPError) -> float | None:
+    headers = getattr(exc, "headers", None)
+    raw = headers.get("Retry-After") if headers is not None else None
+    if not raw:
+        return None
+    try:
+        return max(0.0, float(str(raw).strip()))
+    except ValueError:
+        return None
 
 
-def _build_dataset_context_text() -> str:
-    return (
-        "Dataset semantics:\n"
-        "- routes = route definitions.\n"
-        "- trips = route-level trip/ticket records; each trip belongs to one route via trips.route_id.\n"
-        "- stop_times = stop events for each trip (arrival/departure/sequence), linking trips to stops.\n"
-        "- stops = stop metadata.\n"
-        "- routes do not connect directly to stops; derive route stops via routes -> trips -> stop_times -> stops.\n"
-        "- There are no fare, payment, or rider-count transaction tables in this dataset."
-    )
+@lru_cache(maxsize=1)
+def _gemini_ssl_context() -> ssl.SSLContext:
+    # urlopen otherwise builds a default context, reloading the CA bundle, per connection.
+    return ssl.create_default_context()
 
 
 def _call_gemini_json(
@@ -919,18 +1314,23 @@ def _call_gemini_json(
     }
     request = urlrequest.Request(
         url=url,
-        data=json.dumps(payload).encode("utf-8"),
+        data=json.dumps(payload, separators=(",", ":")).encode("utf-8"),
         headers={"Content-Type": "application/json"},
         method="POST",
     )
 
     attempts = retry_count + 1
-    raw: str | None = None
+    estimated_tokens = len(prompt) // 4
+    raw: bytes | None = None
     last_error_message = ""
     for attempt in range(1, attempts + 1):
+        _GEMINI_RATE_LIMITER.acquire(estimated_tokens)
         try:
-            with urlrequest.urlopen(request, timeout=timeout_seconds) as response:
-                raw = response.read().decode("utf-8")
+            with urlrequest.urlopen(
+                request, timeout=timeout_seconds, context=_gemini_ssl_context()
+            ) as response:
+                # json.loads accepts UTF-8 bytes directly; skip the intermediate str.
+                raw = response.read()
             break
         except urlerror.HTTPError as exc:
             detail = _extract_http_error_detail(exc)
@@ -938,8 +1338,12 @@ def _call_gemini_json(
             last_error_message = (
                 f"Gemini request failed for model '{model}' with HTTP {exc.code}{suffix}."
             )
-            if attempt < attempts and exc.code in {408, 429, 500, 502, 503, 504}:
-                time.sleep(0.5 * attempt)
+            retry_after = _parse_retry_after(exc) if exc.code == 429 else None
+            if retry_after is not None:
+                # Cap the shared block too, so one large Retry-After cannot stall every caller.
+                _GEMINI_RATE_LIMITER.block_for(min(retry_after, _GEMINI_BACKOFF_CAP_SECONDS))
+            if attempt < attempts and exc.code in _GEMINI_RETRY_STATUS_CODES:
+                time.sleep(_retry_delay_seconds(attempt, retry_after))
                 continue
             raise AgentSchemaError(last_error_message) from exc
         except urlerror.URLError as exc:
@@ -949,13 +1353,13 @@ def _call_gemini_json(
                 f"Gemini request failed for model '{model}' due to network error{suffix}."
             )
             if attempt < attempts:
-                time.sleep(0.5 * attempt)
+                time.sleep(_retry_delay_seconds(attempt))
                 continue
             raise AgentSchemaError(last_error_message) from exc
         except TimeoutError as exc:
             last_error_message = f"Gemini request timed out for model '{model}'."
             if attempt < attempts:
-                time.sleep(0.5 * attempt)
+                time.sleep(_retry_delay_seconds(attempt))
                 continue
             raise AgentSchemaError(last_error_message) from exc
 
@@ -964,14 +1368,26 @@ def _call_gemini_json(
 
     try:
         payload_json = json.loads(raw)
-    except json.JSONDecodeError as exc:
+    except (json.JSONDecodeError, UnicodeDecodeError) as exc:
         raise AgentSchemaError("Gemini API response was not valid JSON.") from exc
 
     candidates = payload_json.get("candidates", [])
     if not candidates:
         raise AgentSchemaError("Gemini returned no candidates.")
-    parts = candidates[0].get("content", {}).get("parts", [])
-    text_output = "".join(part.get("text", "") for part in parts if isinstance(part, dict)).strip()
+    try:
+        parts = candidates[0]["content"]["parts"] or []
+    except (KeyError, TypeError):
+        parts = []
+    if not isinstance(parts, list):
+        parts = []
+    if len(parts) == 1 and isinstance(parts[0], dict):
+        # Gemini nearly always returns a single part.
+        text_value = parts[0].get("text")
+        text_output = text_value.strip() if isinstance(text_value, str) else ""
+    else:
+        text_output = "".join(
+            [part["text"] for part in parts if isinstance(part, dict) and isinstance(part.get("text"), str)]
+        ).strip()
     if not text_output:
         raise AgentSchemaError("Gemini returned empty schema content.")
     return text_output
@@ -998,22 +1414,124 @@ def _extract_http_error_detail(exc: urlerror.HTTPError) -> str:
 
 
 def _extract_json_object(raw_text: str) -> dict[str, Any]:
+    return _extract_json_object_with_text(raw_text)[0]
+
+
+def _extract_json_object_with_text(raw_text: str) -> tuple[dict[str, Any], str]:
     text_payload = raw_text.strip()
     if text_payload.startswith("```"):
-        text_payload = re.sub(r"^```(?:json)?\s*", "", text_payload, flags=re.IGNORECASE)
-        text_payload = re.sub(r"\s*```$", "", text_payload)
+        text_payload = text_payload[3:]
+        if text_payload[:4].lower() == "json":
+            text_payload = text_payload[4:]
+        text_payload = text_payload.lstrip()
+        if text_payload.endswith("```"):
+            text_payload = text_payload[:-3].rstrip()
 
     start = text_payload.find("{")
     end = text_payload.rfind("}")
     if start < 0 or end < 0 or end <= start:
         raise AgentSchemaError("Gemini output did not contain a JSON object.")
+    json_text = text_payload[start : end + 1]
     try:
-        parsed = json.loads(text_payload[start : end + 1])
+        parsed = json.loads(json_text)
     except json.JSONDecodeError as exc:
         raise AgentSchemaError("Gemini output JSON parsing failed.") from exc
     if not isinstance(parsed, dict):
         raise AgentSchemaError("Gemini output must be a JSON object.")
-    return parsed
+    return parsed, json_text
+
+
+def _compile_contract(contract: dict[str, Any]) -> Callable[[Any], bool]:
+    """Compile a small JSON Schema subset into a predicate, once per contract.
+
+    Objects are closed (keys must match ``properties`` exactly) and an empty
+    sub-schema accepts anything.
+    """
+    if not contract:
+        return lambda value: True
+
+    contract_type = contract.get("type")
+    if contract_type == "object":
+        expected_keys = frozenset(contract["properties"])
+        field_checks = tuple(
+            (name, _compile_contract(field_contract))
+            for name, field_contract in contract["properties"].items()
+            if field_contract
+        )
+
+        def check_object(value: Any) -> bool:
+            if not isinstance(value, dict) or value.keys() != expected_keys:
+                return False
+            return all(check(value[name]) for name, check in field_checks)
+
+        return check_object
+
+    if contract_type == "array":
+        item_check = _compile_contract(contract.get("items", {}))
+        return lambda value: isinstance(value, list) and all(map(item_check, value))
+
+    if contract_type == "integer":
+        minimum = contract.get("exclusiveMinimum")
+        if minimum is None:
+            return lambda value: isinstance(value, int)
+        return lambda value: isinstance(value, int) and value > minimum
+
+    if contract_type == "string":
+        if "enum" in contract:
+            allowed = frozenset(contract["enum"])
+            return lambda value: isinstance(value, str) and value in allowed
+        pattern = re.compile(contract["pattern"]) if "pattern" in contract else None
+        min_length = contract.get("minLength", 0)
+        return lambda value: (
+            isinstance(value, str)
+            and len(value) >= min_length
+            and (pattern is None or pattern.search(value) is not None)
+        )
+
+    raise ValueError(f"Unsupported contract type: {contract_type!r}")
+
+
+_DISPLAY_TEMPLATE_CONTRACT: dict[str, Any] = {
+    "type": "object",
+    "properties": {
+        "key": {"type": "string", "minLength": 1},
+        "title_template": {},
+        "columns": {
+            "type": "array",
+            "items": {"type": "object", "properties": {"name": {}, "label": {}}},
+        },
+        "row_id_field": {},
+        "formatting": {
+            "type": "object",
+            "properties": {"time_fields": {}, "latlon_fields": {}, "color_fields": {}},
+        },
+    },
+}
+_QUERY_TEMPLATE_CONTRACT: dict[str, Any] = {
+    "type": "object",
+    "properties": {
+        "key": {"type": "string", "minLength": 1},
+        "description": {},
+        "required_inputs": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "name": {},
+                    "type": {"type": "string", "enum": sorted(_REQUIRED_INPUT_TYPES)},
+                    "notes": {},
+                },
+            },
+        },
+        "sql_template": {"type": "string", "pattern": r"\S"},
+        "params": {"type": "array", "items": {"type": "string"}},
+        "default_limit": {"type": "integer", "exclusiveMinimum": 0},
+        "display_key": {"type": "string", "minLength": 1},
+        "safety_notes": {},
+    },
+}
+_is_valid_display_template = _compile_contract(_DISPLAY_TEMPLATE_CONTRACT)
+_is_valid_query_template = _compile_contract(_QUERY_TEMPLATE_CONTRACT)
 
 
 def _validate_agent_schema(
@@ -1021,66 +1539,84 @@ def _validate_agent_schema(
     truth_schema: dict[str, Any],
     *,
     strict_templates: bool,
+    early_exit: bool = False,
 ) -> list[str]:
+    # early_exit stops at the first failing section for callers that only need pass/fail.
     errors: list[str] = []
-    required_top_keys = {
-        "dialect",
-        "tables",
-        "joins",
-        "query_templates",
-        "display_templates",
-        "constraints",
-    }
-    if set(agent_schema.keys()) != required_top_keys:
+    if len(agent_schema) != len(_AGENT_SCHEMA_TOP_KEYS) or not _AGENT_SCHEMA_TOP_KEYS.issubset(
+        agent_schema
+    ):
         errors.append("Top-level keys must match contract exactly.")
 
     if agent_schema.get("dialect") != "postgres":
         errors.append("dialect must be 'postgres'.")
+    if early_exit and errors:
+        return errors
 
-    truth_tables = truth_schema["tables"]
+    truth_column_sets = _truth_column_sets(truth_schema)
+    truth_table_keys = (
+        _TRUTH_TABLE_KEYS if truth_schema is SOURCE_OF_TRUTH_SCHEMA else frozenset(truth_column_sets)
+    )
     tables = agent_schema.get("tables")
     if not isinstance(tables, dict):
         errors.append("tables must be an object.")
     else:
-        if set(tables.keys()) != set(truth_tables.keys()):
+        if len(tables) != len(truth_table_keys) or not truth_table_keys.issubset(tables):
             errors.append("tables keys must match SOURCE_OF_TRUTH_SCHEMA tables.")
-        for table_name, table_info in truth_tables.items():
+        for table_name, truth_columns in truth_column_sets.items():
             candidate = tables.get(table_name, {})
             columns = candidate.get("columns") if isinstance(candidate, dict) else None
             if not isinstance(columns, list):
                 errors.append(f"tables.{table_name}.columns must be an array.")
                 continue
-            if len(columns) != len(set(columns)):
+            column_set = set(columns)
+            if len(columns) != len(column_set):
                 errors.append(f"tables.{table_name}.columns contains duplicates.")
-            if set(columns) != set(table_info["columns"]):
+            if column_set != truth_columns:
                 errors.append(f"tables.{table_name}.columns must match SOURCE_OF_TRUTH_SCHEMA.")
 
+    if early_exit and errors:
+        return errors
+
     joins = agent_schema.get("joins")
     if not isinstance(joins, list):
         errors.append("joins must be an array.")
     else:
-        allowed_join_set = {_canonical_join(item) for item in truth_schema["joins"]}
-        candidate_join_set = set()
+        allowed_join_set = (
+            _ALLOWED_JOIN_SET
+            if truth_schema is SOURCE_OF_TRUTH_SCHEMA
+            else frozenset(_canonical_join(item) for item in truth_schema["joins"])
+        )
+        candidate_join_set: set[tuple[Any, ...]] = set()
+        joins_allowed = True
         for join in joins:
             if not isinstance(join, dict):
                 errors.append("Each join must be an object.")
                 continue
-            candidate_join_set.add(_canonical_join(join))
-        if candidate_join_set != allowed_join_set:
+            if joins_allowed:
+                canonical = _canonical_join(join)
+                # Stop collecting at the first join outside the allowed set.
+                joins_allowed = canonical in allowed_join_set
+                candidate_join_set.add(canonical)
+        # Every collected join is allowed, so equal sizes means equal sets.
+        if not joins_allowed or len(candidate_join_set) != len(allowed_join_set):
             errors.append("joins must exactly match allowed GTFS joins.")
 
+    if early_exit and errors:
+        return errors
+
+    env_max_limit = _max_result_rows()
     constraints = agent_schema.get("constraints")
     if not isinstance(constraints, dict):
         errors.append("constraints must be an object.")
-        max_limit = _read_int_env("MAX_RESULT_ROWS", 50)
+        max_limit = env_max_limit
     else:
-        if set(constraints.keys()) != {"max_limit", "require_limit", "no_select_star"}:
+        if constraints.keys() != _CONSTRAINTS_KEYS:
             errors.append("constraints keys must match contract.")
         max_limit = constraints.get("max_limit")
         if not isinstance(max_limit, int) or max_limit <= 0:
             errors.append("constraints.max_limit must be a positive integer.")
-            max_limit = _read_int_env("MAX_RESULT_ROWS", 50)
-        env_max_limit = _read_int_env("MAX_RESULT_ROWS", 50)
+            max_limit = env_max_limit
         if isinstance(max_limit, int) and max_limit > env_max_limit:
             errors.append("constraints.max_limit must not exceed MAX_RESULT_ROWS.")
         if constraints.get("require_limit") is not True:
@@ -1088,37 +1624,29 @@ def _validate_agent_schema(
         if constraints.get("no_select_star") is not True:
             errors.append("constraints.no_select_star must be true.")
 
+    if early_exit and errors:
+        return errors
+
     display_templates = agent_schema.get("display_templates")
     display_key_set: set[str] = set()
     if not isinstance(display_templates, list):
         errors.append("display_templates must be an array.")
     else:
         for template in display_templates:
-            if not isinstance(template, dict):
-                errors.append("Each display_template must be an object.")
-                continue
-            expected_keys = {"key", "title_template", "columns", "row_id_field", "formatting"}
-            if set(template.keys()) != expected_keys:
-                errors.append("display_template keys must match contract.")
+            if not _is_valid_display_template(template):
+                # Only walk the template field by field to explain a contract failure.
+                if not isinstance(template, dict):
+                    errors.append("Each display_template must be an object.")
+                    continue
+                errors.extend(_display_template_contract_errors(template))
             key = template.get("key")
-            if not isinstance(key, str) or not key:
-                errors.append("display_template.key must be a non-empty string.")
-            else:
+            if isinstance(key, str) and key:
                 if key in display_key_set:
                     errors.append(f"Duplicate display_template key: {key}")
                 display_key_set.add(key)
-            columns = template.get("columns")
-            if not isinstance(columns, list):
-                errors.append("display_template.columns must be an array.")
-            else:
-                for column in columns:
-                    if not isinstance(column, dict) or set(column.keys()) != {"name", "label"}:
-                        errors.append("display_template.columns items must have name and label.")
-            formatting = template.get("formatting")
-            if not isinstance(formatting, dict):
-                errors.append("display_template.formatting must be an object.")
-            elif set(formatting.keys()) != {"time_fields", "latlon_fields", "color_fields"}:
-                errors.append("display_template.formatting keys must match contract.")
+
+    if early_exit and errors:
+        return errors
 
     query_templates = agent_schema.get("query_templates")
     template_key_set: set[str] = set()
@@ -1126,75 +1654,123 @@ def _validate_agent_schema(
         errors.append("query_templates must be an array.")
     else:
         for template in query_templates:
-            if not isinstance(template, dict):
-                errors.append("Each query_template must be an object.")
-                continue
-            expected_keys = {
-                "key",
-                "description",
-                "required_inputs",
-                "sql_template",
-                "params",
-                "default_limit",
-                "display_key",
-                "safety_notes",
-            }
-            if set(template.keys()) != expected_keys:
-                errors.append("query_template keys must match contract.")
+            if not _is_valid_query_template(template):
+                if not isinstance(template, dict):
+                    errors.append("Each query_template must be an object.")
+                    continue
+                errors.extend(_query_template_contract_errors(template))
             key = template.get("key")
             if not isinstance(key, str) or not key:
-                errors.append("query_template.key must be a non-empty string.")
                 continue
             if key in template_key_set:
                 errors.append(f"Duplicate query_template key: {key}")
             template_key_set.add(key)
 
-            required_inputs = template.get("required_inputs")
-            if not isinstance(required_inputs, list):
-                errors.append(f"query_template '{key}' required_inputs must be an array.")
-            else:
-                for item in required_inputs:
-                    if not isinstance(item, dict):
-                        errors.append(f"query_template '{key}' required_inputs item must be an object.")
-                        continue
-                    if set(item.keys()) != {"name", "type", "notes"}:
-                        errors.append(f"query_template '{key}' required_inputs item keys invalid.")
-                        continue
-                    if item.get("type") not in {"string", "number", "enum", "latlon"}:
-                        errors.append(f"query_template '{key}' has invalid input type.")
-
+            # Cross-field checks the contract cannot express.
             params = template.get("params")
-            if not isinstance(params, list) or not all(isinstance(param, str) for param in params):
-                errors.append(f"query_template '{key}' params must be array of strings.")
-
             sql_template = template.get("sql_template")
-            if not isinstance(sql_template, str) or not sql_template.strip():
-                errors.append(f"query_template '{key}' sql_template must be a non-empty string.")
-            else:
+            if isinstance(sql_template, str) and sql_template.strip():
                 errors.extend(_validate_sql_template(sql_template, max_limit, truth_schema, key))
-                placeholder_ids = [int(item) for item in re.findall(r"\$(\d+)", sql_template)]
-                if placeholder_ids and max(placeholder_ids) > len(params):
+                param_count = len(params) if isinstance(params, list) else 0
+                if _max_placeholder_index(sql_template) > param_count:
                     errors.append(f"query_template '{key}' uses placeholder index outside params.")
 
             default_limit = template.get("default_limit")
-            if not isinstance(default_limit, int) or default_limit <= 0:
-                errors.append(f"query_template '{key}' default_limit must be positive integer.")
-            elif isinstance(max_limit, int) and default_limit > max_limit:
+            if (
+                isinstance(default_limit, int)
+                and default_limit > 0
+                and isinstance(max_limit, int)
+                and default_limit > max_limit
+            ):
                 errors.append(f"query_template '{key}' default_limit exceeds constraints.max_limit.")
 
             display_key = template.get("display_key")
-            if not isinstance(display_key, str) or not display_key:
-                errors.append(f"query_template '{key}' display_key must be a non-empty string.")
-            elif display_key_set and display_key not in display_key_set:
+            if (
+                isinstance(display_key, str)
+                and display_key
+                and display_key_set
+                and display_key not in display_key_set
+            ):
                 errors.append(f"query_template '{key}' references unknown display_key '{display_key}'.")
+            if early_exit and errors:
+                return errors
+
+    if early_exit and errors:
+        return errors
 
-    if strict_templates and not _REQUIRED_TEMPLATE_KEYS.issubset(template_key_set):
+    if strict_templates and (
+        len(template_key_set) < len(_REQUIRED_TEMPLATE_KEYS)
+        or not _REQUIRED_TEMPLATE_KEYS.issubset(template_key_set)
+    ):
         missing = sorted(_REQUIRED_TEMPLATE_KEYS - template_key_set)
         errors.append(f"query_templates missing required keys: {', '.join(missing)}")
 
     return errors
 
 
+def _display_template_contract_errors(template: dict[str, Any]) -> list[str]:
+    errors: list[str] = []
+    if template.keys() != _DISPLAY_TEMPLATE_KEYS:
+        errors.append("display_template keys must match contract.")
+    key = template.get("key")
+    if not isinstance(key, str) or not key:
+        errors.append("display_template.key must be a non-empty string.")
+    columns = template.get("columns")
+    if not isinstance(columns, list):
+        errors.append("display_template.columns must be an array.")
+    else:
+        for column in columns:
+            if not isinstance(column, dict) or column.keys() != _DISPLAY_COLUMN_KEYS:
+                errors.append("display_template.columns items must have name and label.")
+    formatting = template.get("formatting")
+    if not isinstance(formatting, dict):
+        errors.append("display_template.formatting must be an object.")
+    elif formatting.keys() != _FORMATTING_KEYS:
+        errors.append("display_template.formatting keys must match contract.")
+    return errors
+
+
+def _query_template_contract_errors(template: dict[str, Any]) -> list[str]:
+    errors: list[str] = []
+    if template.keys() != _QUERY_TEMPLATE_KEYS:
+        errors.append("query_template keys must match contract.")
+    key = template.get("key")
+    if not isinstance(key, str) or not key:
+        errors.append("query_template.key must be a non-empty string.")
+        return errors
+
+    required_inputs = template.get("required_inputs")
+    if not isinstance(required_inputs, list):
+        errors.append(f"query_template '{key}' required_inputs must be an array.")
+    else:
+        for item in required_inputs:
+            if not isinstance(item, dict):
+                errors.append(f"query_template '{key}' required_inputs item must be an object.")
+                continue
+            if item.keys() != _REQUIRED_INPUT_KEYS:
+                errors.append(f"query_template '{key}' required_inputs item keys invalid.")
+                continue
+            if item.get("type") not in _REQUIRED_INPUT_TYPES:
+                errors.append(f"query_template '{key}' has invalid input type.")
+
+    params = template.get("params")
+    if not isinstance(params, list) or not all(isinstance(param, str) for param in params):
+        errors.append(f"query_template '{key}' params must be array of strings.")
+
+    sql_template = template.get("sql_template")
+    if not isinstance(sql_template, str) or not sql_template.strip():
+        errors.append(f"query_template '{key}' sql_template must be a non-empty string.")
+
+    default_limit = template.get("default_limit")
+    if not isinstance(default_limit, int) or default_limit <= 0:
+        errors.append(f"query_template '{key}' default_limit must be positive integer.")
+
+    display_key = template.get("display_key")
+    if not isinstance(display_key, str) or not display_key:
+        errors.append(f"query_template '{key}' display_key must be a non-empty string.")
+    return errors
+
+
 def _normalize_agent_schema(
     agent_schema: dict[str, Any],
     truth_schema: dict[str, Any],
@@ -1202,11 +1778,14 @@ def _normalize_agent_schema(
     if not isinstance(agent_schema, dict):
         return agent_schema
 
-    normalized = copy.deepcopy(agent_schema)
-    env_max_limit = _read_int_env("MAX_RESULT_ROWS", 50)
+    # Copy only the containers rewritten below; tables, joins and display
+    # templates are shared with the input and must not be mutated here.
+    normalized = dict(agent_schema)
+    env_max_limit = _max_result_rows()
 
     constraints = normalized.get("constraints")
     if isinstance(constraints, dict):
+        constraints = normalized["constraints"] = dict(constraints)
         max_limit = constraints.get("max_limit")
         if not isinstance(max_limit, int) or max_limit <= 0:
             max_limit = env_max_limit
@@ -1217,22 +1796,24 @@ def _normalize_agent_schema(
     else:
         max_limit = env_max_limit
 
-    truth_table_names = set(truth_schema.get("tables", {}).keys())
+    truth_tables_re = _truth_tables_pattern(truth_schema)
     query_templates = normalized.get("query_templates")
     if isinstance(query_templates, list):
+        query_templates = normalized["query_templates"] = [
+            dict(template) if isinstance(template, dict) else template
+            for template in query_templates
+        ]
         for template in query_templates:
             if not isinstance(template, dict):
                 continue
 
             sql_template = template.get("sql_template")
             if isinstance(sql_template, str) and sql_template.strip():
-                table_refs = {
-                    table_name
-                    for table_name in truth_table_names
-                    if re.search(rf"\b{re.escape(table_name)}\b", sql_template.lower())
-                }
-                if table_refs:
-                    template["sql_template"] = _normalize_sql_limit_clause(sql_template, max_limit)
+                lower_sql = sql_template.lower()
+                if truth_tables_re is not None and truth_tables_re.search(lower_sql):
+                    template["sql_template"] = _normalize_sql_limit_clause(
+                        sql_template, max_limit, lower_sql=lower_sql
+                    )
 
             default_limit = template.get("default_limit")
             if not isinstance(default_limit, int) or default_limit <= 0:
@@ -1243,46 +1824,46 @@ def _normalize_agent_schema(
     return normalized
 
 
-def _normalize_sql_limit_clause(sql_template: str, max_limit: int) -> str:
+def _truth_tables_pattern(truth_schema: dict[str, Any]) -> re.Pattern[str] | None:
+    if truth_schema is SOURCE_OF_TRUTH_SCHEMA:
+        return _TRUTH_TABLES_RE
+    table_names = truth_schema.get("tables", {})
+    if not table_names:
+        return None
+    return re.compile(r"\b(?:" + "|".join(map(re.escape, table_names)) + r")\b")
+
+
+def _normalize_sql_limit_clause(
+    sql_template: str,
+    max_limit: int,
+    *,
+    lower_sql: str | None = None,
+) -> str:
     sql = sql_template.strip()
-    lower_sql = sql.lower()
-
-    least_match = re.search(r"\blimit\s+least\s*\(\s*\$(\d+)\s*,\s*(\d+)\s*\)", lower_sql)
-    if least_match:
-        current_bound = int(least_match.group(2))
-        if current_bound > max_limit:
-            return re.sub(
-                r"\blimit\s+least\s*\(\s*\$(\d+)\s*,\s*\d+\s*\)",
+    # Surrounding whitespace does not change what the scan finds, so a caller's
+    # already-lowercased template can be reused as is.
+    scan = _scan_sql_template(lower_sql if lower_sql is not None else sql.lower())
+
+    if scan.least_limit is not None:
+        if scan.least_limit[1] > max_limit:
+            return _LIMIT_LEAST_RE.sub(
                 lambda match: f"LIMIT LEAST(${match.group(1)}, {max_limit})",
                 sql,
                 count=1,
-                flags=re.IGNORECASE,
             )
         return sql
 
-    param_limit_match = re.search(r"\blimit\s+\$(\d+)\b", lower_sql)
-    if param_limit_match:
-        placeholder_idx = param_limit_match.group(1)
-        return re.sub(
-            r"\blimit\s+\$\d+\b",
-            f"LIMIT LEAST(${placeholder_idx}, {max_limit})",
+    if scan.param_limit is not None:
+        return _LIMIT_PARAM_RE.sub(
+            f"LIMIT LEAST(${scan.param_limit}, {max_limit})",
             sql,
             count=1,
-            flags=re.IGNORECASE,
         )
 
-    const_limit_match = re.search(r"\blimit\s+(\d+)\b", lower_sql)
-    if const_limit_match:
-        current_bound = int(const_limit_match.group(1))
-        if current_bound <= max_limit:
+    if scan.const_limit is not None:
+        if scan.const_limit <= max_limit:
             return sql
-        return re.sub(
-            r"\blimit\s+\d+\b",
-            f"LIMIT {max_limit}",
-            sql,
-            count=1,
-            flags=re.IGNORECASE,
-        )
+        return _LIMIT_CONST_RE.sub(f"LIMIT {max_limit}", sql, count=1)
 
     sql_no_semicolon = sql.rstrip().rstrip(";")
     return f"{sql_no_semicolon} LIMIT {max_limit}"
@@ -1296,24 +1877,26 @@ def _validate_sql_template(
 ) -> list[str]:
     errors: list[str] = []
     lower_sql = sql_template.lower()
-    if re.search(r"\bselect\s+\*", lower_sql):
+    scan = _scan_sql_template(lower_sql)
+    if scan.select_star:
         errors.append(f"query_template '{template_key}' uses SELECT * which is not allowed.")
 
-    limit_bound = _extract_limit_bound(lower_sql)
+    limit_bound = scan.limit_bound
     if limit_bound is None:
         errors.append(f"query_template '{template_key}' must include a bounded LIMIT.")
     elif limit_bound > max_limit:
         errors.append(f"query_template '{template_key}' LIMIT exceeds constraints.max_limit.")
 
     alias_map = _extract_alias_map(lower_sql)
-    for identifier, column in re.findall(r"\b([a-z_][a-z0-9_]*)\.([a-z_][a-z0-9_]*)\b", lower_sql):
-        table_name = alias_map.get(identifier, identifier if identifier in truth_schema["tables"] else None)
+    columns_by_table = _truth_column_sets(truth_schema)
+    for identifier, column in scan.qualified_columns:
+        table_name = alias_map.get(identifier, identifier if identifier in columns_by_table else None)
         if not table_name:
             continue
-        if table_name not in truth_schema["tables"]:
+        allowed_columns = columns_by_table.get(table_name)
+        if allowed_columns is None:
             errors.append(f"query_template '{template_key}' references unknown table '{table_name}'.")
             continue
-        allowed_columns = set(truth_schema["tables"][table_name]["columns"])
         if column not in allowed_columns:
             errors.append(
                 f"query_template '{template_key}' references unknown column '{identifier}.{column}'."
@@ -1321,31 +1904,67 @@ def _validate_sql_template(
     return errors
 
 
-def _extract_alias_map(lower_sql: str) -> dict[str, str]:
+def _truth_column_sets(truth_schema: dict[str, Any]) -> dict[str, frozenset[str]]:
+    if truth_schema is SOURCE_OF_TRUTH_SCHEMA:
+        return _TRUTH_COLUMN_SETS
+    return {
+        table_name: frozenset(table_info["columns"])
+        for table_name, table_info in truth_schema["tables"].items()
+    }
+
+
+@lru_cache(maxsize=256)
+def _extract_alias_map(lower_sql: str) -> Mapping[str, str]:
+    # Cached per template text; the read-only view keeps the shared result intact.
     alias_map: dict[str, str] = {}
-    reserved = {"on", "where", "group", "order", "limit", "left", "inner", "right", "join"}
-    pattern = re.compile(
-        r"\b(from|join)\s+([a-z_][a-z0-9_]*)(?:\s+(?:as\s+)?([a-z_][a-z0-9_]*))?",
-        re.IGNORECASE,
-    )
-    for match in pattern.finditer(lower_sql):
-        table_name = match.group(2).lower()
-        alias = (match.group(3) or table_name).lower()
-        if alias in reserved:
+    for table_name, alias in _TABLE_ALIAS_RE.findall(lower_sql):
+        if not alias or alias in _RESERVED_ALIAS_WORDS:
             alias = table_name
         alias_map[alias] = table_name
         alias_map.setdefault(table_name, table_name)
-    return alias_map
-
-
-def _extract_limit_bound(lower_sql: str) -> int | None:
-    least_match = re.search(r"\blimit\s+least\s*\(\s*\$\d+\s*,\s*(\d+)\s*\)", lower_sql)
-    if least_match:
-        return int(least_match.group(1))
-    const_match = re.search(r"\blimit\s+(\d+)\b", lower_sql)
-    if const_match:
-        return int(const_match.group(1))
-    return None
+    return MappingProxyType(alias_map)
+
+
+@dataclass(frozen=True, slots=True)
+class _SqlTemplateScan:
+    select_star: bool
+    # First occurrence of each LIMIT form; LEAST wins over $N, which wins over a constant.
+    least_limit: tuple[int, int] | None
+    param_limit: int | None
+    const_limit: int | None
+    qualified_columns: tuple[tuple[str, str], ...]
+
+    @property
+    def limit_bound(self) -> int | None:
+        if self.least_limit is not None:
+            return self.least_limit[1]
+        return self.const_limit
+
+
+@lru_cache(maxsize=256)
+def _scan_sql_template(lower_sql: str) -> _SqlTemplateScan:
+    select_star = False
+    least_limit: tuple[int, int] | None = None
+    param_limit: int | None = None
+    const_limit: int | None = None
+    qualified_columns: list[tuple[str, str]] = []
+    for match in _SQL_TEMPLATE_TOKEN_RE.finditer(lower_sql):
+        kind = match.lastgroup
+        if kind == "column":
+            qualified_columns.append((match["qualifier"], match["column_name"]))
+        elif kind == "select_star":
+            select_star = True
+        elif kind == "limit_least":
+            if least_limit is None:
+                least_limit = (int(match["least_index"]), int(match["least_bound"]))
+        elif kind == "limit_param":
+            if param_limit is None:
+                param_limit = int(match["param_index"])
+        elif const_limit is None:
+            const_limit = int(match["const_bound"])
+    return _SqlTemplateScan(
+        select_star, least_limit, param_limit, const_limit, tuple(qualified_columns)
+    )
 
 
 def _canonical_join(join: dict[str, Any]) -> tuple[str, str, str, str, str, str | None]:
@@ -1359,45 +1978,25 @@ def _canonical_join(join: dict[str, Any]) -> tuple[str, str, str, str, str, str
     )
 
 
-def _choose_template_key(user_text: str, template_map: dict[str, dict[str, Any]]) -> str | None:
-    text_lower = user_text.lower()
+_ALLOWED_JOIN_SET = frozenset(_canonical_join(join) for join in SOURCE_OF_TRUTH_SCHEMA["joins"])
+
+
+def _choose_template_key(
+    user_text: str | _UserTextView,
+    template_map: dict[str, dict[str, Any]],
+) -> str | None:
+    text_lower = _as_user_text_view(user_text).lower
     if "stop_service_volume" in template_map:
-        if re.search(r"\bhow many\b.*\bpeople\b", text_lower) and re.search(
-            r"\b(?:at|to|for)\b",
-            text_lower,
-        ):
+        if _HOW_MANY_PEOPLE_RE.search(text_lower) and _LOCATION_PREPOSITION_RE.search(text_lower):
             return "stop_service_volume"
 
-    ordered_rules = [
-        (
-            "stop_service_volume",
-            (
-                "how many people went to",
-                "how many people at",
-                "how many riders at",
-                "how many riders went to",
-                "how many went to",
-                "traffic at",
-            ),
-        ),
-        ("arrivals_for_stop", ("arrival", "arrivals", "departure", "departures", "schedule")),
-        ("routes_serving_stop", ("routes serving", "serve stop", "which routes stop")),
-        ("stops_on_route", ("stops on route", "stops for route", "route stops")),
-        ("busiest_stops", ("busiest stop", "busiest stops", "top stop", "top stops", "most used stop", "most used stops")),
-        ("busiest_routes", ("busiest route", "busiest routes", "top route", "top routes", "most used route", "most used routes")),
-        ("accessible_stops", ("accessible stops", "wheelchair stops")),
-        ("accessible_trips", ("accessible trips", "wheelchair trips")),
-        ("route_details", ("route details", "details for route", "route info")),
-        ("stop_details", ("stop details", "details for stop", "stop info")),
-        ("list_stops", ("nearby stops", "list stops", "show stops")),
-        ("list_routes", ("list routes", "show routes", "all routes")),
-    ]
-
-    for key, signals in ordered_rules:
-        if key not in template_map:
-            continue
-        if any(signal in text_lower for signal in signals):
-            return key
+    matched_keys = {
+        _TEMPLATE_SIGNAL_KEYS[match.group(1)] for match in _TEMPLATE_SIGNAL_RE.finditer(text_lower)
+    }
+    if matched_keys:
+        for key, _ in _TEMPLATE_INTENT_RULES:
+            if key in matched_keys and key in template_map:
+                return key
 
     if "busiest" in text_lower:
         if "stop" in text_lower and "busiest_stops" in template_map:
@@ -1407,19 +2006,7 @@ def _choose_template_key(user_text: str, template_map: dict[str, dict[str, Any]]
 
     # Avoid routing specific intents to generic list templates when specialized
     # templates are unavailable; ask clarifying instead.
-    specific_intent_markers = (
-        "busiest",
-        "arrival",
-        "arrivals",
-        "departure",
-        "departures",
-        "accessible",
-        "accessibility",
-        "serving",
-        "details",
-        "nearby",
-    )
-    if any(marker in text_lower for marker in specific_intent_markers):
+    if _SPECIFIC_INTENT_RE.search(text_lower):
         return None
 
     if "route" in text_lower and "list_routes" in template_map:
@@ -1431,41 +2018,43 @@ def _choose_template_key(user_text: str, template_map: dict[str, dict[str, Any]]
     return None
 
 
-def _extract_user_values(user_text: str) -> dict[str, Any]:
+def _extract_user_values(user_text: str | _UserTextView) -> dict[str, Any]:
     values: dict[str, Any] = {}
-    text_lower = user_text.lower()
+    view = _as_user_text_view(user_text)
+    user_text = view.raw
+    text_lower = view.lower
+
+    matches: dict[str, re.Match[str]] = {}
+    for match in _USER_VALUE_RE.finditer(text_lower):
+        matches.setdefault(match.lastgroup, match)
 
-    quoted_match = re.search(r'"([^"]+)"', user_text)
+    quoted_match = _QUOTED_VALUE_RE.search(user_text)
     if quoted_match:
         values["quoted"] = quoted_match.group(1)
 
-    route_type_match = re.search(r"\broute[_ ]type\s*[:=]?\s*(\d+)\b", text_lower)
+    route_type_match = matches.get("route_type")
     if route_type_match:
-        values["route_type"] = int(route_type_match.group(1))
+        values["route_type"] = int(route_type_match["route_type_value"])
 
-    route_id_match = re.search(r"\broute[_ ]id\s*[:=]?\s*([a-z0-9_-]+)\b", text_lower)
+    route_id_match = matches.get("route_id")
     if route_id_match:
-        values["route_id"] = route_id_match.group(1)
+        values["route_id"] = route_id_match["route_id_value"]
 
-    route_short_match = re.search(r"\broute(?:\s+short\s+name)?\s*[:=]?\s*([a-z0-9_-]+)\b", text_lower)
+    route_short_match = _ROUTE_SHORT_NAME_RE.search(text_lower)
     if route_short_match and route_short_match.group(1) not in {"id", "details", "stops"}:
         values.setdefault("route_short_name", route_short_match.group(1))
 
-    stop_id_match = re.search(r"\bstop[_ ]id\s*[:=]?\s*([a-z0-9_-]+)\b", text_lower)
+    stop_id_match = matches.get("stop_id")
     if stop_id_match:
-        values["stop_id"] = stop_id_match.group(1)
+        values["stop_id"] = stop_id_match["stop_id_value"]
 
-    stop_name_match = re.search(r"\bstop(?:\s+name)?\s*(?:contains|like|named)?\s*\"([^\"]+)\"", user_text, re.I)
+    stop_name_match = _STOP_NAME_RE.search(user_text)
     if stop_name_match:
         values["stop_name"] = stop_name_match.group(1)
     elif "quoted" in values:
         values.setdefault("stop_name", values["quoted"])
     elif "stop_id" not in values:
-        location_match = re.search(
-            r"\b(?:to|at|for)\s+([A-Za-z0-9&'./\-\s]{2,}?)(?:[?.!,;:]\s*)?$",
-            user_text,
-            re.I,
-        )
+        location_match = _TRAILING_LOCATION_RE.search(user_text)
         if location_match:
             candidate = location_match.group(1).strip().strip(".,!?;:")
             candidate_lower = candidate.lower()
@@ -1484,29 +2073,29 @@ def _extract_user_values(user_text: str) -> dict[str, Any]:
             if candidate and candidate_lower not in disallowed and not candidate_lower.startswith("stop_id"):
                 values["stop_name"] = candidate
 
-    lat_match = re.search(r"\blat(?:itude)?\s*[:=]?\s*(-?\d+(?:\.\d+)?)", text_lower)
-    lon_match = re.search(r"\b(?:lon|lng|longitude)\s*[:=]?\s*(-?\d+(?:\.\d+)?)", text_lower)
+    lat_match = matches.get("lat")
+    lon_match = matches.get("lon")
     if lat_match and lon_match:
-        values["lat"] = float(lat_match.group(1))
-        values["lon"] = float(lon_match.group(1))
+        values["lat"] = float(lat_match["lat_value"])
+        values["lon"] = float(lon_match["lon_value"])
     else:
-        pair_match = re.search(r"(-?\d+\.\d+)\s*,\s*(-?\d+\.\d+)", text_lower)
+        pair_match = matches.get("pair")
         if pair_match:
-            values["lat"] = float(pair_match.group(1))
-            values["lon"] = float(pair_match.group(2))
+            values["lat"] = float(pair_match["pair_lat"])
+            values["lon"] = float(pair_match["pair_lon"])
 
-    radius_match = re.search(r"(\d+(?:\.\d+)?)\s*(?:km|kilometer|kilometers)\b", text_lower)
+    radius_match = matches.get("radius")
     if radius_match:
-        values["radius_km"] = float(radius_match.group(1))
+        values["radius_km"] = float(radius_match["radius_value"])
 
-    top_match = re.search(r"\btop\s+(\d+)\b", text_lower)
+    top_match = matches.get("top")
     if top_match:
-        values["limit"] = int(top_match.group(1))
-        values["top_n"] = int(top_match.group(1))
+        values["limit"] = int(top_match["top_value"])
+        values["top_n"] = int(top_match["top_value"])
     else:
-        limit_match = re.search(r"\blimit\s+(\d+)\b", text_lower)
+        limit_match = matches.get("limit")
         if limit_match:
-            values["limit"] = int(limit_match.group(1))
+            values["limit"] = int(limit_match["limit_value"])
 
     return values
 
@@ -1523,21 +2112,16 @@ def _compute_row_limit(extracted: dict[str, Any], template: dict[str, Any], max_
 
 def _resolve_param_value(param_name: str, extracted: dict[str, Any], row_limit: int) -> Any:
     normalized = param_name.lower()
-    if normalized in {"limit", "top_n", "n"}:
+    if normalized in _ROW_LIMIT_PARAM_NAMES:
         return row_limit
-    if normalized in {"route_type"}:
-        return extracted.get("route_type")
-    if normalized in {"route_id"}:
-        return extracted.get("route_id")
-    if normalized in {"route_short_name"}:
-        return extracted.get("route_short_name")
-    if normalized in {"stop_id"}:
-        return extracted.get("stop_id")
-    if normalized in {"stop_name", "stop_name_substring", "name_substring"}:
+    extracted_key = _PARAM_EXTRACTED_KEYS.get(normalized)
+    if extracted_key is not None:
+        return extracted.get(extracted_key)
+    if normalized in _STOP_NAME_PARAM_NAMES:
         return extracted.get("stop_name") or extracted.get("quoted")
-    if "lat" == normalized or normalized.endswith("_lat"):
+    if normalized.endswith("_lat"):
         return extracted.get("lat")
-    if normalized in {"lon", "lng"} or normalized.endswith("_lon"):
+    if normalized.endswith("_lon"):
         return extracted.get("lon")
     if "radius" in normalized:
         radius = extracted.get("radius_km")
@@ -1556,37 +2140,40 @@ def _has_required_value(value: Any) -> bool:
 
 
 def _apply_sql_safety(sql: str, params: list[Any], row_limit: int, max_limit: int) -> tuple[str, list[Any]]:
-    lower_sql = sql.lower()
-    if re.search(r"\bselect\s+\*", lower_sql):
+    if _SELECT_STAR_RE.search(sql):
         raise QueryPlanError("Unsafe query plan: SELECT * is not allowed.")
 
-    placeholders = [int(value) for value in re.findall(r"\$(\d+)", sql)]
-    if placeholders and max(placeholders) > len(params):
+    if _max_placeholder_index(sql) > len(params):
         raise QueryPlanError("Unsafe query plan: placeholder index is out of bounds.")
 
-    limit_least_match = re.search(r"\blimit\s+least\s*\(\s*\$(\d+)\s*,\s*(\d+)\s*\)", lower_sql)
-    if limit_least_match:
-        param_idx = int(limit_least_match.group(1)) - 1
-        template_cap = int(limit_least_match.group(2))
-        safe_limit = min(row_limit, max_limit, template_cap)
-        if 0 <= param_idx < len(params):
-            params[param_idx] = safe_limit
-        return sql, params
+    # LEAST(...) wins over LIMIT $n, which wins over a constant, wherever each appears.
+    limit_param_match = None
+    limit_const_match = None
+    for match in _LIMIT_CLAUSE_RE.finditer(sql):
+        least_index, least_bound, param_index, const_bound = match.groups()
+        if least_index is not None:
+            param_idx = int(least_index) - 1
+            safe_limit = min(row_limit, max_limit, int(least_bound))
+            if 0 <= param_idx < len(params):
+                params[param_idx] = safe_limit
+            return sql, params
+        if param_index is not None:
+            limit_param_match = limit_param_match or match
+        elif limit_const_match is None:
+            limit_const_match = match
 
-    limit_param_match = re.search(r"\blimit\s+\$(\d+)\b", lower_sql)
     if limit_param_match:
-        param_idx = int(limit_param_match.group(1)) - 1
+        param_idx = int(limit_param_match.group(3)) - 1
         safe_limit = min(row_limit, max_limit)
         if 0 <= param_idx < len(params):
             params[param_idx] = safe_limit
         return sql, params
 
-    limit_const_match = re.search(r"\blimit\s+(\d+)\b", lower_sql)
     if limit_const_match:
-        current_limit = int(limit_const_match.group(1))
+        current_limit = int(limit_const_match.group(4))
         safe_limit = min(current_limit, max_limit)
         if safe_limit != current_limit:
-            sql = re.sub(r"\blimit\s+\d+\b", f"LIMIT {safe_limit}", sql, flags=re.IGNORECASE)
+            sql = _LIMIT_CONST_RE.sub(f"LIMIT {safe_limit}", sql)
         return sql, params
 
     sql = sql.rstrip().rstrip(";")
@@ -1595,20 +2182,58 @@ def _apply_sql_safety(sql: str, params: list[Any], row_limit: int, max_limit: in
 
 
 def _convert_postgres_params(sql: str, params: list[Any]) -> tuple[str, dict[str, Any]]:
+    converted, bindings = _compile_postgres_placeholders(sql)
+    param_count = len(params)
     bind_params: dict[str, Any] = {}
-
-    def repl(match: re.Match[str]) -> str:
-        idx = int(match.group(1))
-        if idx <= 0 or idx > len(params):
+    for name, idx in bindings:
+        if idx <= 0 or idx > param_count:
             raise QueryPlanError(f"Invalid SQL placeholder index ${idx}.")
-        key = f"p{idx}"
-        bind_params[key] = params[idx - 1]
-        return f":{key}"
-
-    converted = re.sub(r"\$(\d+)", repl, sql)
+        bind_params[name] = params[idx - 1]
     return converted, bind_params
 
 
+@lru_cache(maxsize=256)
+def _compile_postgres_placeholders(sql: str) -> tuple[str, tuple[tuple[str, int], ...]]:
+    # Templates repeat, so the $N -> :pN rewrite and bind names are cached per SQL string.
+    indexes = [int(match.group(1)) for match in _PLACEHOLDER_RE.finditer(sql)]
+    converted = _PLACEHOLDER_RE.sub(lambda match: f":p{int(match.group(1))}", sql)
+    # A placeholder reused in the SQL binds once, in order of first appearance.
+    return converted, tuple((f"p{idx}", idx) for idx in dict.fromkeys(indexes))
+
+
+@lru_cache(maxsize=256)
+def _text_clause(converted_sql: str) -> TextClause:
+    return text(converted_sql)
+
+
+def _max_placeholder_index(sql: str) -> int:
+    # Single str.find scan for the highest $N; 0 when there are no placeholders.
+    highest = 0
+    length = len(sql)
+    position = sql.find("$")
+    while position >= 0:
+        end = position + 1
+        while end < length and "0" <= sql[end] <= "9":
+            end += 1
+        if end > position + 1:
+            value = int(sql[position + 1 : end])
+            if value > highest:
+                highest = value
+        position = sql.find("$", end)
+    return highest
+
+
+def clearEnvCache() -> None:
+    _read_int_env.cache_clear()
+    _read_float_env.cache_clear()
+    _clear_db_env_cache()
+
+
+def _max_result_rows() -> int:
+    return _read_int_env("MAX_RESULT_ROWS", 50)
+
+
+@lru_cache(maxsize=None)
 def _read_int_env(name: str, default: int) -> int:
     raw = os.getenv(name, "").strip()
     if not raw:
@@ -1619,6 +2244,7 @@ def _read_int_env(name: str, default: int) -> int:
         return default
 
 
+@lru_cache(maxsize=None)
 def _read_float_env(name: str, default: float) -> float:
     raw = os.getenv(name, "").strip()
     if not raw:
@@ -1671,6 +2297,7 @@ __all__ = [
     "QueryPlanError",
     "SOURCE_OF_TRUTH_SCHEMA",
     "clearAgentSchemaCache",
+    "clearEnvCache",
     "executeParameterizedQuery",
     "getAgentSchema",
     "getAgentSchemaStatus",
@@ -82,16 +82,20 @@ def process_user_message(user_text: str) -> ChatResponse:
             is_database_question=False,
         )
 
+    agent_status = None
     try:
         agent_schema = getAgentSchema()
         agent_status = getAgentSchemaStatus()
         query_plan = proposeQueryPlan(user_text, agent_schema)
     except (AgentSchemaError, QueryPlanError) as exc:
+        # Only re-read the status when the schema build itself failed.
+        if agent_status is None:
+            agent_status = getAgentSchemaStatus()
         return ChatResponse(
             assistant_message="I could not build a safe GTFS query plan right now.",
             error=str(exc),
             is_database_question=True,
-            agent_status=getAgentSchemaStatus(),
+            agent_status=agent_status,
         )
 
     clarifying_question = query_plan.get("clarifying_question")
@@ -165,7 +169,7 @@ def _friendly_db_error(raw_error: str) -> str:
 
 
 @app.get("/")
-def root() -> FileResponse:
+async def root() -> FileResponse:
     return FileResponse(STATIC_DIR / "index.html")
 
 
@@ -175,5 +179,5 @@ def chat(request: ChatRequest) -> ChatResponse:
 
 
 @app.get("/health")
-def health() -> dict[str, Any]:
+async def health() -> dict[str, Any]:
     return {"ok": True}
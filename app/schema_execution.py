@@ -1,18 +1,49 @@
 import re
 from collections import defaultdict, deque
+from threading import Lock
 from typing import Any
 
-from sqlalchemy import text
 from sqlalchemy.exc import SQLAlchemyError
 
 from app.db import get_engine
+from app.schema_options import getSchemaOptions
 
 _IDENTIFIER_RE = re.compile(r"^[a-z_][a-z0-9_]*$")
+_CREATE_TABLE_SQL = 'CREATE TABLE IF NOT EXISTS "%s" (%s)'
+_COLUMN_SQL = '"%s" %s%s%s%s'
+_COLUMN_DEFAULT_SQL = " DEFAULT %s"
+_FOREIGN_KEY_SQL = 'FOREIGN KEY ("%s") REFERENCES "%s" ("%s") ON DELETE %s'
+_CREATE_INDEX_SQL = 'CREATE %sINDEX IF NOT EXISTS "%s" ON "%s" (%s)'
 _ON_DELETE_SQL = {
     "restrict": "RESTRICT",
     "cascade": "CASCADE",
     "set null": "SET NULL",
 }
+_STATEMENT_CACHE: dict[str, tuple[str, ...]] = {}
+_STATEMENT_CACHE_LOCK = Lock()
+_STATEMENT_CACHE_SIZE = 64
+
+
+def _collect_option_identifiers(schema_options: dict[str, Any]) -> frozenset[str]:
+    names: list[str] = []
+    for option in schema_options.get("table_options", []):
+        table = option.get("table", {})
+        names.append(table.get("name"))
+        names.extend(column.get("name") for column in table.get("columns", []))
+        for index in table.get("indexes", []):
+            names.append(index.get("name"))
+            names.extend(index.get("columns", []))
+        for foreign_key in table.get("foreign_keys", []):
+            names.extend(
+                (foreign_key.get("column"), foreign_key.get("ref_table"), foreign_key.get("ref_column"))
+            )
+    return frozenset(
+        name for name in names if isinstance(name, str) and _IDENTIFIER_RE.fullmatch(name)
+    )
+
+
+# Identifiers from the static schema options, validated once so _safe_ident can skip the regex.
+_PREVALIDATED_IDENTIFIERS = _collect_option_identifiers(getSchemaOptions())
 
 
 class SchemaExecutionError(RuntimeError):
@@ -29,26 +60,62 @@ def execute_schema_proposal(
 
 
 def build_schema_statements(proposed_schema: dict[str, Any]) -> list[str]:
+    # Proposals repeat across turns, so DDL is memoized per proposal. repr keeps list/tuple
+    # and key types distinct, and a miss builds from the original object, so validation is
+    # exactly the uncached path's.
+    cache_key = repr(proposed_schema)
+    with _STATEMENT_CACHE_LOCK:
+        cached = _STATEMENT_CACHE.get(cache_key)
+    if cached is None:
+        cached = tuple(_build_schema_statements_uncached(proposed_schema))
+        with _STATEMENT_CACHE_LOCK:
+            if len(_STATEMENT_CACHE) >= _STATEMENT_CACHE_SIZE:
+                _STATEMENT_CACHE.pop(next(iter(_STATEMENT_CACHE)))
+            _STATEMENT_CACHE[cache_key] = cached
+    return list(cached)
+
+
+def _build_schema_statements_uncached(proposed_schema: dict[str, Any]) -> list[str]:
     tables = proposed_schema.get("tables", [])
     if not isinstance(tables, list):
         raise SchemaExecutionError("proposed_schema.tables must be an array.")
 
     ordered_tables = _topological_order_tables(tables)
+    option_ddl = [_prebuilt_option_ddl(table) for table in ordered_tables]
     statements: list[str] = []
 
-    for table in ordered_tables:
-        statements.append(_build_create_table_statement(table))
-    for table in ordered_tables:
-        statements.extend(_build_index_statements(table))
+    for table, prebuilt in zip(ordered_tables, option_ddl):
+        statements.append(prebuilt[0] if prebuilt else _build_create_table_statement(table))
+    for table, prebuilt in zip(ordered_tables, option_ddl):
+        statements.extend(prebuilt[1] if prebuilt else _build_index_statements(table))
 
     return statements
 
 
+def _prebuilt_option_ddl(table: dict[str, Any]) -> tuple[str, tuple[str, ...]] | None:
+    prebuilt = _OPTION_TABLE_DDL.get(table.get("name"))
+    # Only a table proposed verbatim from the options may reuse its prebuilt DDL.
+    if prebuilt is None or prebuilt[0] != table:
+        return None
+    return prebuilt[1], prebuilt[2]
+
+
 def execute_statements(statements: list[str], *, mode: str = "dry_run") -> dict[str, Any]:
     normalized_mode = mode.strip().lower()
     if normalized_mode not in {"dry_run", "apply"}:
         raise SchemaExecutionError("mode must be one of: dry_run, apply.")
 
+    if normalized_mode == "dry_run":
+        # A dry run only needs the generated DDL; skip the connect/execute/rollback cycle.
+        return {
+            "executed": False,
+            "mode": normalized_mode,
+            "success": True,
+            "statement_count": len(statements),
+            "statements": statements,
+            "error": None,
+        }
+
     try:
         engine = get_engine()
     except Exception as exc:
@@ -61,18 +128,15 @@ def execute_statements(statements: list[str], *, mode: str = "dry_run") -> dict[
             "error": str(exc),
         }
 
-    should_commit = normalized_mode == "apply"
-
     try:
-        with engine.connect() as connection:
+        # no_parameters stops the DBAPI from %-formatting the DDL (e.g. DEFAULT '100%').
+        with engine.connect().execution_options(no_parameters=True) as connection:
             transaction = connection.begin()
             try:
-                for statement in statements:
-                    connection.execute(text(statement))
-                if should_commit:
-                    transaction.commit()
-                else:
-                    transaction.rollback()
+                if statements:
+                    # One driver-level round trip for the whole DDL batch.
+                    connection.exec_driver_sql(";\n".join(statements))
+                transaction.commit()
             except Exception:
                 transaction.rollback()
                 raise
@@ -120,15 +184,16 @@ def _build_create_table_statement(table: dict[str, Any]) -> str:
         is_unique = bool(column.get("unique"))
         default = column.get("default")
 
-        parts = [_quote_ident(column_name), column_type]
-        if default is not None:
-            parts.append(f"DEFAULT {default}")
-        if not nullable:
-            parts.append("NOT NULL")
-        if is_unique and not is_primary_key:
-            parts.append("UNIQUE")
-
-        column_defs.append(" ".join(parts))
+        column_defs.append(
+            _COLUMN_SQL
+            % (
+                column_name,
+                column_type,
+                _COLUMN_DEFAULT_SQL % (default,) if default is not None else "",
+                "" if nullable else " NOT NULL",
+                " UNIQUE" if is_unique and not is_primary_key else "",
+            )
+        )
         if is_primary_key:
             primary_keys.append(column_name)
 
@@ -153,17 +218,9 @@ def _build_create_table_statement(table: dict[str, Any]) -> str:
                 f"Foreign key on '{table_name}.{fk_column}' has invalid on_delete '{on_delete}'."
             )
 
-        column_defs.append(
-            "FOREIGN KEY ({fk_col}) REFERENCES {ref_table} ({ref_col}) ON DELETE {on_delete}".format(
-                fk_col=_quote_ident(fk_column),
-                ref_table=_quote_ident(ref_table),
-                ref_col=_quote_ident(ref_column),
-                on_delete=on_delete_sql,
-            )
-        )
+        column_defs.append(_FOREIGN_KEY_SQL % (fk_column, ref_table, ref_column, on_delete_sql))
 
-    inner = ", ".join(column_defs)
-    return f"CREATE TABLE IF NOT EXISTS {_quote_ident(table_name)} ({inner})"
+    return _CREATE_TABLE_SQL % (table_name, ", ".join(column_defs))
 
 
 def _build_index_statements(table: dict[str, Any]) -> list[str]:
@@ -187,17 +244,12 @@ def _build_index_statements(table: dict[str, Any]) -> list[str]:
             for column_name in columns
         )
         unique_sql = "UNIQUE " if unique else ""
-        statements.append(
-            f"CREATE {unique_sql}INDEX IF NOT EXISTS {_quote_ident(index_name)} "
-            f"ON {_quote_ident(table_name)} ({quoted_columns})"
-        )
+        statements.append(_CREATE_INDEX_SQL % (unique_sql, index_name, table_name, quoted_columns))
     return statements
 
 
 def _topological_order_tables(tables: list[dict[str, Any]]) -> list[dict[str, Any]]:
     table_by_name: dict[str, dict[str, Any]] = {}
-    dependencies: dict[str, set[str]] = defaultdict(set)
-    dependents: dict[str, set[str]] = defaultdict(set)
 
     for table in tables:
         table_name = _safe_ident(table.get("name"), "table.name")
@@ -205,36 +257,43 @@ def _topological_order_tables(tables: list[dict[str, Any]]) -> list[dict[str, An
             raise SchemaExecutionError(f"Duplicate table name '{table_name}'.")
         table_by_name[table_name] = table
 
+    # Kahn's algorithm; ties are broken by input order, so no sorting is needed.
+    in_degree = dict.fromkeys(table_by_name, 0)
+    dependents: dict[str, list[str]] = defaultdict(list)
     for table_name, table in table_by_name.items():
+        seen_refs: set[str] = set()
         for foreign_key in table.get("foreign_keys", []):
             ref_table = _safe_ident(
                 foreign_key.get("ref_table"),
                 f"{table_name}.foreign_keys.ref_table",
             )
-            if ref_table in table_by_name and ref_table != table_name:
-                dependencies[table_name].add(ref_table)
-                dependents[ref_table].add(table_name)
+            if ref_table in table_by_name and ref_table != table_name and ref_table not in seen_refs:
+                seen_refs.add(ref_table)
+                dependents[ref_table].append(table_name)
+                in_degree[table_name] += 1
 
-    in_degree = {table_name: len(dependencies[table_name]) for table_name in table_by_name}
-    queue = deque(sorted(name for name, degree in in_degree.items() if degree == 0))
+    queue = deque(name for name, degree in in_degree.items() if degree == 0)
     ordered: list[dict[str, Any]] = []
 
     while queue:
         current = queue.popleft()
         ordered.append(table_by_name[current])
-        for dependent in sorted(dependents[current]):
+        for dependent in dependents[current]:
             in_degree[dependent] -= 1
             if in_degree[dependent] == 0:
                 queue.append(dependent)
 
-    if len(ordered) != len(tables):
-        return [table_by_name[name] for name in sorted(table_by_name.keys())]
+    if len(ordered) != len(table_by_name):
+        # FK cycle: keep what could be ordered, then the rest in input order.
+        return ordered + [table_by_name[name] for name, degree in in_degree.items() if degree > 0]
     return ordered
 
 
 def _safe_ident(value: Any, label: str) -> str:
     if not isinstance(value, str):
         raise SchemaExecutionError(f"{label} must be a string.")
+    if value in _PREVALIDATED_IDENTIFIERS:
+        return value
     name = value.strip().lower()
     if not _IDENTIFIER_RE.match(name):
         raise SchemaExecutionError(
@@ -245,3 +304,21 @@ def _safe_ident(value: Any, label: str) -> str:
 
 def _quote_ident(identifier: str) -> str:
     return f'"{identifier}"'
+
+
+def _prebuild_option_ddl(
+    schema_options: dict[str, Any],
+) -> dict[str, tuple[dict[str, Any], str, tuple[str, ...]]]:
+    prebuilt: dict[str, tuple[dict[str, Any], str, tuple[str, ...]]] = {}
+    for option in schema_options.get("table_options", []):
+        table = option.get("table", {})
+        prebuilt[table.get("name")] = (
+            table,
+            _build_create_table_statement(table),
+            tuple(_build_index_statements(table)),
+        )
+    return prebuilt
+
+
+# Tables proposed verbatim from the static options reuse DDL rendered once at import.
+_OPTION_TABLE_DDL = _prebuild_option_ddl(getSchemaOptions())
@@ -1,4 +1,4 @@
-from copy import deepcopy
+import pickle
 from typing import Any
 
 _SCHEMA_OPTIONS: dict[str, Any] = {
@@ -241,5 +241,9 @@ _SCHEMA_OPTIONS: dict[str, Any] = {
 }
 
 
+# Callers may mutate the options they receive; unpickling a snapshot is a much cheaper deep copy.
+_SCHEMA_OPTIONS_SNAPSHOT = pickle.dumps(_SCHEMA_OPTIONS, protocol=pickle.HIGHEST_PROTOCOL)
+
+
 def getSchemaOptions() -> dict[str, Any]:
-    return deepcopy(_SCHEMA_OPTIONS)
+    return pickle.loads(_SCHEMA_OPTIONS_SNAPSHOT)
@@ -1,9 +1,10 @@
-import copy
 import hashlib
 import json
 import os
 import re
+import ssl
 import time
+from functools import lru_cache
 from threading import Lock
 from typing import Any, Literal
 from urllib import error as urlerror
@@ -35,6 +36,7 @@ _VALID_POSTGRES_TYPES = {
 }
 _NUMERIC_PATTERN = re.compile(r"^numeric\(\d+(,\d+)?\)$", re.IGNORECASE)
 _VARCHAR_PATTERN = re.compile(r"^varchar\(\d+\)$", re.IGNORECASE)
+_CODE_FENCE_PATTERN = re.compile(r"\A```(?:json)?\s*|\s*```\Z", re.IGNORECASE)
 
 _TOP_LEVEL_KEYS = {"schema_name", "dialect", "tables", "selected_options", "rationale"}
 _TABLE_KEYS = {"name", "columns", "indexes", "foreign_keys"}
@@ -187,6 +189,12 @@ def clearSchemaProposalCache() -> None:
         _SCHEMA_CACHE.clear()
 
 
+def clearEnvCache() -> None:
+    _get_cache_ttl_seconds.cache_clear()
+    _get_gemini_model.cache_clear()
+    _get_gemini_timeout_seconds.cache_clear()
+
+
 def _build_cache_key(user_request: str, schema_options: dict[str, Any]) -> str:
     version = str(schema_options.get("version", "v0"))
     normalized_request = " ".join(user_request.split()).strip().lower()
@@ -194,6 +202,7 @@ def _build_cache_key(user_request: str, schema_options: dict[str, Any]) -> str:
     return hashlib.sha256(raw_key.encode("utf-8")).hexdigest()
 
 
+@lru_cache(maxsize=None)
 def _get_cache_ttl_seconds() -> int:
     raw_ttl = os.getenv("SCHEMA_CACHE_SECONDS", "300")
     try:
@@ -216,7 +225,8 @@ def _get_cached_schema(cache_key: str) -> ProposedSchema | None:
         if now - created_at > ttl_seconds:
             _SCHEMA_CACHE.pop(cache_key, None)
             return None
-        return _coerce_proposed_schema(copy.deepcopy(payload))
+        # Validation builds fresh models and lists, so the cached payload is never shared.
+        return _coerce_proposed_schema(payload)
 
 
 def _set_cached_schema(cache_key: str, schema: ProposedSchema) -> None:
@@ -226,9 +236,10 @@ def _set_cached_schema(cache_key: str, schema: ProposedSchema) -> None:
 
     payload = proposedSchemaToDict(schema)
     with _SCHEMA_CACHE_LOCK:
-        _SCHEMA_CACHE[cache_key] = (time.time(), copy.deepcopy(payload))
+        _SCHEMA_CACHE[cache_key] = (time.time(), payload)
 
 
+@lru_cache(maxsize=None)
 def _get_gemini_model() -> str:
     configured = os.getenv("GEMINI_MODEL", "").strip()
     if configured:
@@ -236,6 +247,7 @@ def _get_gemini_model() -> str:
     return DEFAULT_GEMINI_MODEL
 
 
+@lru_cache(maxsize=None)
 def _get_gemini_timeout_seconds() -> float:
     raw_timeout = os.getenv("GEMINI_TIMEOUT_SECONDS", "20")
     try:
@@ -244,6 +256,12 @@ def _get_gemini_timeout_seconds() -> float:
         return 20.0
 
 
+@lru_cache(maxsize=1)
+def _gemini_ssl_context() -> ssl.SSLContext:
+    # urlopen otherwise builds a default context, reloading the CA bundle, per connection.
+    return ssl.create_default_context()
+
+
 def _call_gemini_schema(prompt: str) -> str:
     api_key = os.getenv("GEMINI_API_KEY", "").strip()
     if not api_key:
@@ -260,7 +278,7 @@ def _call_gemini_schema(prompt: str) -> str:
             "responseMimeType": "application/json",
         },
     }
-    body = json.dumps(payload).encode("utf-8")
+    body = json.dumps(payload, separators=(",", ":")).encode("utf-8")
     request = urlrequest.Request(
         url=url,
         data=body,
@@ -269,7 +287,9 @@ def _call_gemini_schema(prompt: str) -> str:
     )
 
     try:
-        with urlrequest.urlopen(request, timeout=timeout_seconds) as response:
+        with urlrequest.urlopen(
+            request, timeout=timeout_seconds, context=_gemini_ssl_context()
+        ) as response:
             raw_response = response.read().decode("utf-8")
     except urlerror.HTTPError as exc:
         raise SchemaSynthesisError(f"Gemini request failed with HTTP {exc.code}.") from exc
@@ -287,8 +307,19 @@ def _call_gemini_schema(prompt: str) -> str:
     if not candidates:
         raise SchemaSynthesisError("Gemini returned no candidates.")
 
-    parts = candidates[0].get("content", {}).get("parts", [])
-    text_output = "".join(part.get("text", "") for part in parts if isinstance(part, dict)).strip()
+    try:
+        parts = candidates[0]["content"]["parts"] or []
+    except (KeyError, TypeError):
+        parts = []
+    if not isinstance(parts, list):
+        parts = []
+    if len(parts) == 1 and isinstance(parts[0], dict):
+        text_value = parts[0].get("text")
+        text_output = text_value.strip() if isinstance(text_value, str) else ""
+    else:
+        text_output = "".join(
+            [part["text"] for part in parts if isinstance(part, dict) and isinstance(part.get("text"), str)]
+        ).strip()
     if not text_output:
         raise SchemaSynthesisError("Gemini returned an empty candidate payload.")
     return text_output
@@ -379,8 +410,7 @@ def _coerce_proposed_schema(payload: dict[str, Any]) -> ProposedSchema:
 def _extract_json_payload(raw_text: str) -> dict[str, Any]:
     text = raw_text.strip()
     if text.startswith("```"):
-        text = re.sub(r"^```(?:json)?\s*", "", text, flags=re.IGNORECASE)
-        text = re.sub(r"\s*```$", "", text)
+        text = _CODE_FENCE_PATTERN.sub("", text)
 
     start = text.find("{")
     end = text.rfind("}")
@@ -613,6 +643,7 @@ __all__ = [
     "ProposedSchema",
     "SchemaSynthesisError",
     "SchemaValidationError",
+    "clearEnvCache",
     "clearSchemaProposalCache",
     "getSchemaOptions",
     "isDatabaseQuestion",
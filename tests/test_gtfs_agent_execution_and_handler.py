@@ -1,22 +1,28 @@
 import unittest
 from unittest.mock import patch
 
-from app.gtfs_agent import executeParameterizedQuery
+from app.gtfs_agent import executeParameterizedQuery, renderDisplayPayload
 from app.main import process_user_message, warm_agent_schema
 
 
-class _FakeRow:
-    def __init__(self, payload):
-        self._mapping = payload
+class _FakeRow(tuple):
+    def __new__(cls, payload):
+        row = super().__new__(cls, payload.values())
+        row._mapping = payload
+        return row
 
 
 class _FakeResult:
     def __init__(self, rows):
         self._rows = [_FakeRow(item) for item in rows]
+        self._keys = list(rows[0]) if rows else []
 
     def __iter__(self):
         return iter(self._rows)
 
+    def keys(self):
+        return self._keys
+
 
 class _FakeConnection:
     def __init__(self, rows):
@@ -59,9 +65,42 @@ class ExecutionAndHandlerTests(unittest.TestCase):
 
         self.assertTrue(result["success"])
         self.assertEqual(result["row_count"], 2)
+        self.assertEqual(result["rows"], [{"route_id": "1"}, {"route_id": "2"}])
+        self.assertEqual(result["columns"], ["route_id"])
         self.assertIn(":p1", fake_connection.last_sql)
         self.assertEqual(fake_connection.last_params["p1"], 2)
 
+    def test_render_display_payload_projects_template_columns(self):
+        agent_schema = {
+            "display_templates": [
+                {
+                    "key": "routes_table",
+                    "title_template": "Routes ({row_count})",
+                    "columns": [
+                        {"name": "route_id", "label": "Route ID"},
+                        {"name": "route_short_name", "label": "Name"},
+                    ],
+                    "row_id_field": "route_id",
+                    "formatting": {"time_fields": [], "latlon_fields": [], "color_fields": []},
+                }
+            ]
+        }
+        rows = [
+            {"route_id": "1", "route_short_name": "A", "extra": "x"},
+            {"route_id": "2"},
+        ]
+
+        payload = renderDisplayPayload(rows, {"display_key": "routes_table"}, agent_schema)
+
+        self.assertEqual(payload["title"], "Routes (2)")
+        self.assertEqual(
+            payload["rows"],
+            [
+                {"route_id": "1", "route_short_name": "A"},
+                {"route_id": "2", "route_short_name": None},
+            ],
+        )
+
     def test_process_user_message_non_db_skips_agent_schema(self):
         with patch("app.main.getAgentSchema", side_effect=AssertionError("must not call")):
             response = process_user_message("Tell me a joke about transit.")
@@ -70,6 +109,9 @@ class ExecutionAndHandlerTests(unittest.TestCase):
         self.assertFalse(response.query_executed)
         self.assertIsNone(response.agent_schema)
 
+        response.rows.append({"leaked": True})
+        self.assertEqual(process_user_message("Tell me a joke about transit.").rows, [])
+
     def test_process_user_message_db_returns_display_payload(self):
         agent_schema = {
             "display_templates": [
@@ -2,7 +2,7 @@ import os
 import unittest
 from unittest.mock import patch
 
-from app.gtfs_agent import proposeQueryPlan
+from app.gtfs_agent import _apply_sql_safety, clearEnvCache, proposeQueryPlan
 
 
 def _planning_schema(max_limit: int = 50) -> dict:
@@ -224,8 +224,12 @@ def _planning_schema(max_limit: int = 50) -> dict:
 
 class QueryPlanningTests(unittest.TestCase):
     def setUp(self):
+        clearEnvCache()
         self.schema = _planning_schema()
 
+    def tearDown(self):
+        clearEnvCache()
+
     def test_arrivals_requires_stop_id(self):
         plan = proposeQueryPlan("Show arrivals for this stop", self.schema)
         self.assertIsNotNone(plan["clarifying_question"])
@@ -370,6 +374,23 @@ class QueryPlanningTests(unittest.TestCase):
         self.assertIsNone(plan["sql"])
         self.assertEqual(mocked_call.call_count, 2)
 
+    def test_sql_safety_prefers_least_then_param_then_constant_limit(self):
+        sql, params = _apply_sql_safety(
+            "SELECT stops.stop_id FROM stops LIMIT 500 UNION SELECT stops.stop_id FROM stops "
+            "limit least($1, 20)",
+            [99],
+            10,
+            50,
+        )
+        self.assertIn("LIMIT 500", sql)
+        self.assertEqual(params, [10])
+
+        sql, params = _apply_sql_safety("SELECT stops.stop_id FROM stops LIMIT $1", [99], 80, 50)
+        self.assertEqual(params, [50])
+
+        sql, params = _apply_sql_safety("SELECT stops.stop_id FROM stops Limit 500", [], 10, 50)
+        self.assertEqual(sql, "SELECT stops.stop_id FROM stops LIMIT 50")
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -1,16 +1,26 @@
 import copy
+import io
 import json
 import os
+import threading
+import time
 import unittest
 from unittest.mock import patch
+from urllib import error as urlerror
 
 from app.gtfs_agent import (
     AgentSchemaError,
+    _GEMINI_BACKOFF_CAP_SECONDS,
+    _GEMINI_RATE_LIMITER,
+    _GeminiRateLimiter,
     _call_gemini_json,
+    _is_valid_query_template,
     _normalize_agent_schema,
+    _scan_sql_template,
     SOURCE_OF_TRUTH_SCHEMA,
     _validate_agent_schema,
     clearAgentSchemaCache,
+    clearEnvCache,
     getAgentSchema,
     getAgentSchemaStatus,
     isDatabaseQuestion,
@@ -198,9 +208,13 @@ def _sample_agent_schema(max_limit: int = 50) -> dict:
 class AgentSchemaTests(unittest.TestCase):
     def setUp(self):
         clearAgentSchemaCache()
+        clearEnvCache()
+        _GEMINI_RATE_LIMITER.reset()
 
     def tearDown(self):
         clearAgentSchemaCache()
+        clearEnvCache()
+        _GEMINI_RATE_LIMITER.reset()
 
     def test_is_database_question_true(self):
         self.assertTrue(isDatabaseQuestion("Show arrivals for stop_id 1234"))
@@ -222,6 +236,58 @@ class AgentSchemaTests(unittest.TestCase):
         )
         self.assertTrue(any("tables.routes.columns" in error for error in errors))
 
+    def test_compiled_contract_flags_invalid_query_template(self):
+        schema = _sample_agent_schema()
+        template = schema["query_templates"][1]
+        self.assertTrue(_is_valid_query_template(template))
+
+        template["required_inputs"][0]["type"] = "uuid"
+        self.assertFalse(_is_valid_query_template(template))
+        errors = _validate_agent_schema(schema, SOURCE_OF_TRUTH_SCHEMA, strict_templates=False)
+        self.assertIn("query_template 'route_details' has invalid input type.", errors)
+
+    def test_scan_sql_template_collects_limits_and_columns_in_one_pass(self):
+        scan = _scan_sql_template(
+            "select r.route_id, stops.stop_name from routes r "
+            "join stops on stops.stop_id = r.route_id limit 5 limit least($2, 40)"
+        )
+        self.assertFalse(scan.select_star)
+        self.assertEqual(scan.least_limit, (2, 40))
+        self.assertEqual(scan.const_limit, 5)
+        self.assertIsNone(scan.param_limit)
+        self.assertEqual(scan.limit_bound, 40)
+        self.assertEqual(
+            scan.qualified_columns,
+            (("r", "route_id"), ("stops", "stop_name"), ("stops", "stop_id"), ("r", "route_id")),
+        )
+        self.assertTrue(_scan_sql_template("select * from routes limit $1").select_star)
+        self.assertEqual(_scan_sql_template("select * from routes limit $1").param_limit, 1)
+
+    def test_validation_rejects_unknown_or_missing_joins(self):
+        schema = _sample_agent_schema()
+        schema["joins"].append(dict(schema["joins"][0], right_column="invented_column"))
+        errors = _validate_agent_schema(schema, SOURCE_OF_TRUTH_SCHEMA, strict_templates=False)
+        self.assertIn("joins must exactly match allowed GTFS joins.", errors)
+
+        schema = _sample_agent_schema()
+        schema["joins"].pop()
+        errors = _validate_agent_schema(schema, SOURCE_OF_TRUTH_SCHEMA, strict_templates=False)
+        self.assertIn("joins must exactly match allowed GTFS joins.", errors)
+
+    def test_validation_early_exit_stops_at_first_failing_section(self):
+        schema = _sample_agent_schema()
+        schema["tables"]["routes"]["columns"].append("invented_column")
+        schema["constraints"]["require_limit"] = False
+        full_errors = _validate_agent_schema(
+            schema, SOURCE_OF_TRUTH_SCHEMA, strict_templates=False
+        )
+        early_errors = _validate_agent_schema(
+            schema, SOURCE_OF_TRUTH_SCHEMA, strict_templates=False, early_exit=True
+        )
+        self.assertIn("constraints.require_limit must be true.", full_errors)
+        self.assertTrue(early_errors)
+        self.assertTrue(all("tables.routes.columns" in error for error in early_errors))
+
     def test_normalize_agent_schema_clamps_max_limit_and_adds_limit(self):
         schema = _sample_agent_schema()
         schema["constraints"]["max_limit"] = 500
@@ -231,7 +297,9 @@ class AgentSchemaTests(unittest.TestCase):
         schema["query_templates"][1]["sql_template"] = (
             "SELECT stops.stop_id, stops.stop_name FROM stops WHERE ($1::text IS NULL OR stops.stop_name ILIKE '%' || $1 || '%')"
         )
+        original = copy.deepcopy(schema)
         normalized = _normalize_agent_schema(schema, SOURCE_OF_TRUTH_SCHEMA)
+        self.assertEqual(schema, original)
         errors = _validate_agent_schema(
             normalized,
             SOURCE_OF_TRUTH_SCHEMA,
@@ -254,12 +322,70 @@ class AgentSchemaTests(unittest.TestCase):
         self.assertEqual(mocked.call_count, 1)
         self.assertEqual(first["dialect"], "postgres")
         self.assertEqual(second["dialect"], "postgres")
+        self.assertIs(first, second)
+
+    def test_get_agent_schema_builds_once_under_concurrent_misses(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        def slow_build():
+            started.set()
+            release.wait(timeout=5)
+            return _sample_agent_schema()
+
+        results = []
+        with patch("app.gtfs_agent._build_agent_schema_uncached", side_effect=slow_build) as mocked:
+            threads = [threading.Thread(target=lambda: results.append(getAgentSchema())) for _ in range(4)]
+            threads[0].start()
+            started.wait(timeout=5)
+            for thread in threads[1:]:
+                thread.start()
+            release.set()
+            for thread in threads:
+                thread.join(timeout=5)
+
+        self.assertEqual(mocked.call_count, 1)
+        self.assertEqual(len(results), 4)
+        self.assertTrue(all(result is results[0] for result in results))
+
+    def test_get_agent_schema_shares_a_failing_build_with_concurrent_misses(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        def failing_build(_truth_schema):
+            started.set()
+            release.wait(timeout=5)
+            raise AgentSchemaError("Gemini request failed with HTTP 503.")
+
+        errors = []
+
+        def call():
+            try:
+                getAgentSchema()
+            except AgentSchemaError as exc:
+                errors.append(exc)
+
+        with patch(
+            "app.gtfs_agent.proposeAgentSchemaFromTruth", side_effect=failing_build
+        ) as mocked:
+            threads = [threading.Thread(target=call) for _ in range(4)]
+            threads[0].start()
+            started.wait(timeout=5)
+            for thread in threads[1:]:
+                thread.start()
+            time.sleep(0.1)
+            release.set()
+            for thread in threads:
+                thread.join(timeout=5)
+
+        self.assertEqual(mocked.call_count, 1)
+        self.assertEqual(len(errors), 4)
 
     def test_get_agent_schema_status_falls_back_to_last_known_good_cache(self):
         with patch.dict(os.environ, {"SCHEMA_CACHE_SECONDS": "0"}, clear=False):
             with patch(
                 "app.gtfs_agent.proposeAgentSchemaFromTruth",
-                return_value=_sample_agent_schema(),
+                return_value=(_sample_agent_schema(), json.dumps(_sample_agent_schema())),
             ):
                 first_schema = getAgentSchema()
             with patch(
@@ -274,11 +400,34 @@ class AgentSchemaTests(unittest.TestCase):
         self.assertEqual(second_schema["dialect"], "postgres")
         self.assertEqual(first_schema, second_schema)
 
+    def test_repair_prompt_reuses_gemini_schema_text(self):
+        broken_schema = _sample_agent_schema()
+        broken_schema["dialect"] = "mysql"
+        prompts = []
+
+        def fake_call(prompt, **_kwargs):
+            prompts.append(prompt)
+            return json.dumps(_sample_agent_schema())
+
+        with patch(
+            "app.gtfs_agent.proposeAgentSchemaFromTruth",
+            return_value=(broken_schema, "{\"dialect\":\"mysql\"}"),
+        ):
+            with patch("app.gtfs_agent._call_gemini_json", side_effect=fake_call):
+                schema = getAgentSchema()
+
+        self.assertEqual(schema["dialect"], "postgres")
+        self.assertEqual(getAgentSchemaStatus()["source"], "gemini_repair")
+        self.assertEqual(len(prompts), 1)
+        self.assertTrue(prompts[0].endswith("previousSchema={\"dialect\":\"mysql\"}"))
+
     def test_call_gemini_json_retries_after_timeout(self):
         call_count = {"value": 0}
+        contexts = []
 
-        def fake_urlopen(_request, timeout):
+        def fake_urlopen(_request, timeout, context=None):
             call_count["value"] += 1
+            contexts.append(context)
             self.assertEqual(timeout, 1.0)
             if call_count["value"] == 1:
                 raise TimeoutError("first timeout")
@@ -306,6 +455,103 @@ class AgentSchemaTests(unittest.TestCase):
 
         self.assertEqual(call_count["value"], 2)
         self.assertEqual(output, "{\"ok\":true}")
+        self.assertIsNotNone(contexts[0])
+        self.assertIs(contexts[0], contexts[1])
+
+    def test_call_gemini_json_honors_retry_after_on_429(self):
+        call_count = {"value": 0}
+        clock = {"now": time.monotonic()}
+        sleeps = []
+
+        def fake_sleep(seconds):
+            sleeps.append(seconds)
+            clock["now"] += seconds
+
+        def fake_urlopen(_request, timeout, context=None):
+            call_count["value"] += 1
+            if call_count["value"] == 1:
+                raise urlerror.HTTPError(
+                    "https://example.invalid",
+                    429,
+                    "Too Many Requests",
+                    {"Retry-After": "3"},
+                    io.BytesIO(b""),
+                )
+            return _FakeHTTPResponse(
+                {"candidates": [{"content": {"parts": [{"text": "{\"ok\":true}"}]}}]}
+            )
+
+        with patch.dict(
+            os.environ,
+            {"GEMINI_API_KEY": "test_key", "GEMINI_RETRY_COUNT": "1"},
+            clear=False,
+        ):
+            with patch("app.gtfs_agent.urlrequest.urlopen", side_effect=fake_urlopen):
+                with patch("app.gtfs_agent.time.monotonic", side_effect=lambda: clock["now"]):
+                    with patch("app.gtfs_agent.time.sleep", side_effect=fake_sleep):
+                        output = _call_gemini_json("test prompt")
+
+        self.assertEqual(output, "{\"ok\":true}")
+        self.assertEqual(sleeps, [3.0])
+
+    def test_large_retry_after_does_not_block_later_calls_beyond_cap(self):
+        call_count = {"value": 0}
+        clock = {"now": time.monotonic()}
+        sleeps = []
+
+        def fake_sleep(seconds):
+            sleeps.append(seconds)
+            clock["now"] += seconds
+
+        def fake_urlopen(_request, timeout, context=None):
+            call_count["value"] += 1
+            if call_count["value"] == 1:
+                raise urlerror.HTTPError(
+                    "https://example.invalid",
+                    429,
+                    "Too Many Requests",
+                    {"Retry-After": "3600"},
+                    io.BytesIO(b""),
+                )
+            return _FakeHTTPResponse(
+                {"candidates": [{"content": {"parts": [{"text": "{\"ok\":true}"}]}}]}
+            )
+
+        with patch.dict(
+            os.environ,
+            {"GEMINI_API_KEY": "test_key", "GEMINI_RETRY_COUNT": "0"},
+            clear=False,
+        ):
+            with patch("app.gtfs_agent.urlrequest.urlopen", side_effect=fake_urlopen):
+                with patch("app.gtfs_agent.time.monotonic", side_effect=lambda: clock["now"]):
+                    with patch("app.gtfs_agent.time.sleep", side_effect=fake_sleep):
+                        with self.assertRaises(AgentSchemaError):
+                            _call_gemini_json("first prompt")
+                        output = _call_gemini_json("unrelated prompt")
+
+        self.assertEqual(output, "{\"ok\":true}")
+        self.assertEqual(len(sleeps), 1)
+        self.assertLessEqual(sleeps[0], _GEMINI_BACKOFF_CAP_SECONDS)
+
+    def test_rate_limiter_waits_when_request_budget_is_spent(self):
+        limiter = _GeminiRateLimiter()
+        clock = {"now": 100.0}
+        sleeps = []
+
+        def fake_sleep(seconds):
+            sleeps.append(seconds)
+            clock["now"] += seconds
+
+        with patch.dict(os.environ, {"GEMINI_RPM_LIMIT": "2"}, clear=False):
+            with patch("app.gtfs_agent.time.monotonic", side_effect=lambda: clock["now"]):
+                with patch("app.gtfs_agent.time.sleep", side_effect=fake_sleep):
+                    limiter.acquire(10)
+                    limiter.acquire(10)
+                    self.assertEqual(sleeps, [])
+                    limiter.acquire(10)
+
+        self.assertEqual(len(sleeps), 1)
+        self.assertAlmostEqual(sleeps[0], 30.0)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,120 @@
+import unittest
+from unittest.mock import patch
+
+from sqlalchemy.exc import ProgrammingError
+
+from app.schema_execution import (
+    SchemaExecutionError,
+    build_schema_statements,
+    execute_schema_proposal,
+)
+
+
+class _FakeTransaction:
+    def __init__(self, connection):
+        self._connection = connection
+
+    def commit(self):
+        self._connection.committed = True
+
+    def rollback(self):
+        self._connection.rolled_back = True
+
+
+class _FakeConnection:
+    """Mimics psycopg2's pyformat handling: SQL is %-formatted unless no_parameters is set."""
+
+    def __init__(self, failing_fragment=None):
+        self._failing_fragment = failing_fragment
+        self._options = {}
+        self.executed = []
+        self.committed = False
+        self.rolled_back = False
+
+    def execution_options(self, **options):
+        self._options.update(options)
+        return self
+
+    def begin(self):
+        return _FakeTransaction(self)
+
+    def exec_driver_sql(self, sql):
+        if not self._options.get("no_parameters"):
+            try:
+                sql = sql % {}
+            except (TypeError, ValueError) as exc:
+                raise ProgrammingError(sql, {}, exc) from exc
+        if self._failing_fragment and self._failing_fragment in sql:
+            raise ProgrammingError(sql, None, Exception("relation does not exist"))
+        self.executed.append(sql)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+class _FakeEngine:
+    def __init__(self, failing_fragment=None):
+        self._failing_fragment = failing_fragment
+        self.connections = []
+
+    def connect(self):
+        connection = _FakeConnection(self._failing_fragment)
+        self.connections.append(connection)
+        return connection
+
+
+def _schema_with_default(default):
+    return {
+        "tables": [
+            {
+                "name": "discounts",
+                "columns": [
+                    {"name": "id", "type": "integer", "nullable": False, "primary_key": True},
+                    {"name": "label", "type": "text", "nullable": True, "default": default},
+                ],
+                "foreign_keys": [],
+                "indexes": [{"name": "discounts_label_idx", "columns": ["label"]}],
+            }
+        ]
+    }
+
+
+class SchemaExecutionTests(unittest.TestCase):
+    def test_apply_sends_percent_in_default_verbatim(self):
+        engine = _FakeEngine()
+
+        with patch("app.schema_execution.get_engine", return_value=engine):
+            result = execute_schema_proposal(_schema_with_default("'100%'"), mode="apply")
+
+        self.assertTrue(result["success"], result["error"])
+        connection = engine.connections[0]
+        self.assertTrue(connection.committed)
+        self.assertEqual(len(connection.executed), 1)
+        self.assertIn("DEFAULT '100%'", connection.executed[0])
+
+    def test_apply_failure_reports_the_batch_error(self):
+        engine = _FakeEngine(failing_fragment="discounts_label_idx")
+
+        with patch("app.schema_execution.get_engine", return_value=engine):
+            result = execute_schema_proposal(_schema_with_default(None), mode="apply")
+
+        self.assertFalse(result["success"])
+        self.assertTrue(result["executed"])
+        self.assertIn("relation does not exist", result["error"])
+        self.assertEqual(len(engine.connections), 1)
+        self.assertTrue(engine.connections[0].rolled_back)
+        self.assertFalse(engine.connections[0].committed)
+
+    def test_cached_build_still_rejects_non_array_tables(self):
+        schema = _schema_with_default(None)
+        build_schema_statements(schema)
+
+        with self.assertRaises(SchemaExecutionError):
+            build_schema_statements({"tables": tuple(schema["tables"])})
+
+
+if __name__ == "__main__":
+    unittest.main()